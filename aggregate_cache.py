@@ -0,0 +1,76 @@
+from PACK import *
+
+import numpy as np
+import hashlib
+import math
+import os
+
+from propagate import aggregateRows
+from sampler import batchRNG
+
+def graphDigest(adj_lists):
+    '''
+    fingerprint of a CSRGraph, used to tell cached aggregations of different graphs apart.
+    '''
+    md5 = hashlib.md5()
+    for array in [adj_lists.indptr, adj_lists.indices, adj_lists.weights]:
+        md5.update(np.ascontiguousarray(array).tobytes())
+    return md5.hexdigest()[:12]
+
+class AggregationCache(object):
+    '''
+    precomputed neighbor aggregation of an Encoder whose embedding is frozen.
+    without sampling (every node has at most num_sample neighbors) the exact neighbor mean is stored once,
+    otherwise variant_num sampled aggregations per node are stored and rotated through by epoch.
+    the cache is a memory-mapped .npy file of shape (variant_num, node_num, feature_dim),
+    reused across runs with the same graph, round and settings.
+    '''
+
+    def __init__(self, encoder, cache_dir, round=0, variant_num=4, dtype='float16', batch_size=1024, seed=0):
+        self.use_cuda = encoder.use_cuda
+        adj_lists = encoder.adj_lists
+        num_sample = encoder.sampler.num_sample
+        exact = num_sample is None or adj_lists.edge_num == 0 or adj_lists.degree().max() <= num_sample
+        self.variant_num = 1 if exact else variant_num
+        self.epoch = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, 'aggregate_{}_r{}_n{}_g{}_v{}_{}.npy'.format(
+            graphDigest(adj_lists), round, num_sample, int(encoder.gcn), self.variant_num, dtype))
+        if not os.path.exists(self.path):
+            self.build(encoder, exact, dtype, batch_size, seed)
+        self.features = np.load(self.path, mmap_mode='r')
+
+    def build(self, encoder, exact, dtype, batch_size, seed):
+        node_num, feature_dim = len(encoder.adj_lists), encoder.feature_dim
+        tmp_path = self.path + '.tmp.npy'
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(self.variant_num, node_num, feature_dim))
+        batch_num = int(math.ceil(node_num / float(batch_size)))
+        with torch.no_grad():
+            if exact:
+                ## rows of A*X by blocks, only the neighbors of a block are looked up from the embedding
+                for batch in range(batch_num):
+                    nodes = np.arange(batch*batch_size, min((batch+1)*batch_size, node_num))
+                    features[0, nodes[0]:nodes[-1]+1] = aggregateRows(encoder.adj_lists, encoder.gcn, encoder.embedding, nodes).cpu().numpy()
+            else:
+                for v in range(self.variant_num):
+                    for batch in range(batch_num):
+                        nodes = np.arange(batch*batch_size, min((batch+1)*batch_size, node_num))
+                        features[v, nodes[0]:nodes[-1]+1] = encoder.aggregate(nodes, batchRNG(seed, v, batch)).cpu().numpy()
+        features.flush()
+        del features
+        os.rename(tmp_path, self.path)
+
+    def setEpoch(self, epoch):
+        self.epoch = epoch
+
+    def __call__(self, nodes):
+        '''
+        cached aggregation of nodes for the current epoch, (len(nodes) x feature_dim).
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        embedded_features = torch.from_numpy(self.features[self.epoch % self.variant_num, nodes].astype(np.float32))
+        if self.use_cuda:
+            embedded_features = embedded_features.cuda()
+        return embedded_features
@@ -1,13 +1,43 @@
 from PACK import *
 
-import random
+def meanAggregate(rows, cols, weights, row_num, features, mode='sparse'):
+    '''
+    weighted mean of features over edges, i.e., for each edge (rows[k], cols[k]) with weight weights[k],
+    out[i] = sum_k w_k * features[cols[k]] / sum_k w_k over the edges k in row i.
+    rows, cols: LongTensor, weights: FloatTensor, one entry per edge.
+    mode='sparse': sparse-dense matmul,
+    mode='index_add': segment sum of gathered features by index_add_,
+    mode='dense': dense (row_num x len(features)) mask.
+    '''
+    row_sum = torch.zeros(row_num, dtype=weights.dtype, device=weights.device).index_add_(0, rows, weights)
+    weights = weights / row_sum[rows]
+    if mode == 'sparse':
+        mask = torch.sparse_coo_tensor(torch.stack((rows, cols)), weights, (row_num, features.size(0)))
+        return torch.sparse.mm(mask, features)
+    elif mode == 'index_add':
+        embedded_features = torch.zeros(row_num, features.size(1), dtype=features.dtype, device=features.device)
+        return embedded_features.index_add_(0, rows, features[cols] * weights.unsqueeze(1))
+    elif mode == 'dense':
+        mask = torch.zeros(row_num, features.size(0), dtype=features.dtype, device=features.device)
+        mask[rows, cols] = weights
+        return mask.mm(features)
+    raise ValueError("unknown aggregation mode: {}".format(mode))
+
+def addSelfLoops(nodes, neigh_index, neigh_weight, weight=1.0):
+    '''
+    append node i to the i-th row of padded neighbors unless the row already contains it (GCN style).
+    '''
+    has_self = (neigh_index == nodes.view(-1, 1)).sum(1) > 0
+    neigh_index = torch.cat((neigh_index, nodes.masked_fill(has_self, -1).view(-1, 1)), dim=1)
+    neigh_weight = torch.cat((neigh_weight, torch.full_like(neigh_weight[:, :1], weight)), dim=1)
+    return neigh_index, neigh_weight
 
 class MeanAggregator(nn.Module):
     '''
     aggregate a node's feature using mean of features of its neighbors
     '''
 
-    def __init__(self, embedding, gcn=False, use_cuda=False):
+    def __init__(self, embedding, gcn=False, use_cuda=False, mode='sparse'):
         '''
         (torch.nn.Embedding)
         embedding is a look up table that stores features of all nodes,
@@ -15,42 +45,32 @@ class MeanAggregator(nn.Module):
 
         gcn=False: perform concatenation GraphSAGE-style
         gcn=True: add self-loops (GCN style).
+
+        mode: 'sparse', 'index_add' or 'dense', see meanAggregate.
         '''
         super(MeanAggregator, self).__init__()
         self.embedding = embedding
         self.gcn = gcn
         self.use_cuda = use_cuda
+        self.mode = mode
 
-    def forward(self, nodes, neighbors, num_sample=10):
+    def forward(self, nodes, neigh_index, neigh_weight):
         '''
-        nodes: list of nodes in a batch
-        neighbors: list of sets, each set includes neighbors of each node
-        num_sample: number of neighbors to sample. No sampling if None
+        nodes: LongTensor of nodes in a batch
+        neigh_index: (batch x k) LongTensor of sampled neighbors of each node, -1 for padding (see NeighborSampler)
+        neigh_weight: (batch x k) FloatTensor of edge weights, ignored here
         '''
-        _set = set
-        if num_sample is not None:
-            _sample = random.sample
-            sample_neighbors = [_set(_sample(neigh, num_sample)) if len(neigh)>=num_sample else neigh for neigh in neighbors]
-        else:
-            sample_neighbors = neighbors
+        if self.use_cuda:
+            nodes, neigh_index, neigh_weight = nodes.cuda(), neigh_index.cuda(), neigh_weight.cuda()
         if self.gcn:
-            sample_neighbors = [(sample_neigh | set([nodes[i]])) for i, sample_neigh in enumerate(sample_neighbors)]
-        unique_nodes_list = list(set.union(*sample_neighbors))
-        unique_nodes = {node:i for i,node in enumerate(unique_nodes_list)}
+            neigh_index, neigh_weight = addSelfLoops(nodes, neigh_index, neigh_weight)
+        valid = neigh_index >= 0
+        unique_nodes_list, col_indices = torch.unique(neigh_index[valid], sorted=True, return_inverse=True)
 
         ## mask[i,j] = 1 means that j-th node appears in i-th neighbor set
-        mask = torch.zeros(len(sample_neighbors), len(unique_nodes))
-        row_indices = [k for k in range(len(sample_neighbors)) for i in range(len(sample_neighbors[k]))]
-        col_indices = [unique_nodes[node] for sample_neigh in sample_neighbors for node in sample_neigh]
-        mask[row_indices, col_indices] = 1
-        if self.use_cuda:
-            mask = mask.cuda()
-        neighbor_num = mask.sum(1, keepdim=True)
-        mask = mask.div(neighbor_num)
-        if self.use_cuda:
-            features_unique_nodes = self.embedding(torch.LongTensor(unique_nodes_list).cuda())
-        else:
-            features_unique_nodes = self.embedding(torch.LongTensor(unique_nodes_list))
-        embedded_features = mask.mm(features_unique_nodes)
+        row_indices = torch.arange(neigh_index.size(0), device=neigh_index.device).view(-1, 1).expand_as(neigh_index)[valid]
+        weights = torch.ones(row_indices.size(0), device=neigh_index.device)
+        features_unique_nodes = self.embedding(unique_nodes_list)
+        embedded_features = meanAggregate(row_indices, col_indices, weights, neigh_index.size(0), features_unique_nodes, self.mode)
 
         return embedded_features
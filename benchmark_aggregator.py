@@ -0,0 +1,73 @@
+from PACK import *
+
+from aggregator_with_weight import MeanAggregator
+from knn import knnGraph
+from sampler import NeighborSampler
+
+import numpy as np
+import time
+import random
+
+import argparse
+import ast
+
+def legacyAggregate(embedding, nodes, neighbors):
+    '''
+    the dense mask filled edge by edge, as MeanAggregator did before the sparse path.
+    '''
+    unique_nodes_list = list(set.union(*[set([neigh[0] for neigh in sample_neigh]) for sample_neigh in neighbors]))
+    unique_nodes = {node:i for i,node in enumerate(unique_nodes_list)}
+    mask = torch.zeros(len(neighbors), len(unique_nodes))
+    for i, sample_neigh in enumerate(neighbors):
+        for node, weight in sample_neigh:
+            mask[i, unique_nodes[node]] = torch.tensor(weight)
+    mask = mask.div(mask.sum(1, keepdim=True))
+    return mask.mm(embedding(torch.LongTensor(unique_nodes_list)))
+
+def timeit(func, repeat):
+    func()
+    start = time.time()
+    for _ in range(repeat):
+        out = func()
+    return (time.time() - start) / repeat * 1000, out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Microbenchmark of MeanAggregator on a random kNN graph.')
+    parser.add_argument('-n', '--node_num', type=int, default=50000, required=False, help='number of nodes.')
+    parser.add_argument('-f', '--feat_dim', type=int, default=512, required=False, help='feature dim of node.')
+    parser.add_argument('-k', '--knn', type=int, default=10, required=False, help='number of neighbors of each node.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, required=False, help='number of timed runs.')
+    parser.add_argument('-l', '--legacy', type=ast.literal_eval, default=True, required=False, help='whether to time the per-edge dense mask (True) or not (False).')
+    args, _ = parser.parse_known_args()
+
+    np.random.seed(0)
+    random.seed(0)
+    feature_map = np.random.randn(args.node_num, args.feat_dim).astype(np.float32)
+    feature_map /= np.linalg.norm(feature_map, axis=1, keepdims=True)
+    ## distinct random neighbors, the first column is the node itself
+    offset = np.concatenate(([0], np.random.choice(np.arange(1, args.node_num), args.knn, replace=False)))
+    sort_id = (np.arange(args.node_num)[:, None] + offset) % args.node_num
+    sort_sim = np.random.rand(args.node_num, args.knn+1).astype(np.float32)
+    adj_lists = knnGraph(sort_id, sort_sim)
+    embedding = nn.Embedding(args.node_num, args.feat_dim)
+    embedding.weight = nn.Parameter(torch.from_numpy(feature_map), requires_grad=False)
+
+    print "batch  " + "  ".join("{:>10}".format(m) for m in ['legacy', 'dense', 'index_add', 'sparse']) + "  (ms)"
+    for batch_size in [128, 256, 512, 1024, 2048, 4096]:
+        nodes = np.random.choice(args.node_num, batch_size, replace=False)
+        neigh_index, neigh_weight = NeighborSampler(adj_lists, None)(nodes)
+        row = []
+        if args.legacy:
+            neighbor_sets = [adj_lists[n] for n in nodes]
+            t, reference = timeit(lambda: legacyAggregate(embedding, nodes, neighbor_sets), 1)
+            row.append(t)
+        else:
+            row.append(float('nan'))
+        for mode in ['dense', 'index_add', 'sparse']:
+            aggregator = MeanAggregator(embedding, gcn=False, mode=mode)
+            t, out = timeit(lambda: aggregator(torch.from_numpy(nodes), neigh_index, neigh_weight), args.repeat)
+            if not args.legacy and mode == 'dense':
+                reference = out
+            assert (out - reference).abs().max().item() < 1e-5
+            row.append(t)
+        print "{:>5}  ".format(batch_size) + "  ".join("{:>10.2f}".format(t) for t in row)
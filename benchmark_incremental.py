@@ -0,0 +1,58 @@
+from PACK import *
+
+from encoder import Encoder
+from incremental import IncrementalGraph
+from knn import buildKnnGraph
+from propagate import FullGraphPropagation
+
+import numpy as np
+import time
+
+import argparse
+import ast
+
+def fullRebuild(feature_map, encoder, knn):
+    '''
+    what adding images costs without incremental updates: kNN graph and encoding of all rows.
+    '''
+    encoder.adj_lists = buildKnnGraph(feature_map, knn)
+    encoder.embedding = nn.Embedding(feature_map.shape[0], feature_map.shape[1])
+    encoder.embedding.weight = nn.Parameter(torch.from_numpy(feature_map), requires_grad=False)
+    return FullGraphPropagation(encoder).encode().t().numpy()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Throughput of incremental insertion into an encoded kNN graph, against full rebuilds.')
+    parser.add_argument('-n', '--node_num', type=int, default=20000, required=False, help='number of indexed nodes before insertion.')
+    parser.add_argument('-i', '--insert_num', type=int, default=1000, required=False, help='number of inserted nodes.')
+    parser.add_argument('-b', '--batch_size', type=int, default=100, required=False, help='number of nodes inserted at once.')
+    parser.add_argument('-f', '--feat_dim', type=int, default=512, required=False, help='feature dim of node.')
+    parser.add_argument('-d', '--embed_dim', type=int, default=512, required=False, help='embedded feature dim of encoder.')
+    parser.add_argument('-k', '--knn', type=int, default=10, required=False, help='number of neighbors of each node.')
+    parser.add_argument('-G', '--use_gcn', type=ast.literal_eval, default=True, required=False, help='whether to use gcn (True) or not (False).')
+    parser.add_argument('-r', '--rebuild', type=ast.literal_eval, default=True, required=False, help='whether to time a full rebuild per batch and check equality (True) or not (False).')
+    args, _ = parser.parse_known_args()
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    feature_map = np.random.randn(args.node_num + args.insert_num, args.feat_dim).astype(np.float32)
+    feature_map /= np.linalg.norm(feature_map, axis=1, keepdims=True)
+    encoder = Encoder(None, args.feat_dim, args.embed_dim, buildKnnGraph(feature_map[:2], 1), num_sample=None, gcn=args.use_gcn)
+
+    start = time.time()
+    graph = IncrementalGraph(feature_map[:args.node_num], encoder, args.knn)
+    print "initial build of {} nodes: {:.2f}s".format(args.node_num, time.time() - start)
+
+    print "{:>8}  {:>8}  {:>12}  {:>12}  {:>10}".format('nodes', 'dirty', 'insert img/s', 'rebuild img/s', 'max diff')
+    for begin in range(args.node_num, args.node_num + args.insert_num, args.batch_size):
+        end = min(begin + args.batch_size, args.node_num + args.insert_num)
+        start = time.time()
+        dirty = graph.insert(feature_map[begin:end])
+        insert_speed = (end - begin) / (time.time() - start)
+        if args.rebuild:
+            start = time.time()
+            reference = fullRebuild(feature_map[:end], encoder, args.knn)
+            rebuild_speed = (end - begin) / (time.time() - start)
+            diff = np.abs(graph.feature_map - reference).max()
+        else:
+            rebuild_speed, diff = float('nan'), float('nan')
+        print "{:>8}  {:>8}  {:>12.1f}  {:>12.1f}  {:>10.2e}".format(end, len(dirty), insert_speed, rebuild_speed, diff)
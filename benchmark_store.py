@@ -0,0 +1,61 @@
+from PACK import *
+
+from feature_store import QuantizedEmbedding
+from encoder import Encoder
+from propagate import FullGraphPropagation
+from collect_graph import collectGraph_test
+from main_single import test_dataset, building
+
+import numpy as np
+import time
+
+import argparse
+import ast
+
+def evalStore(key, feature_map, adj_lists, mode, args, checkpoint=None):
+    '''
+    mAP of base features, mean aggregation and (given a main_single checkpoint) new features, with features stored in mode.
+    '''
+    start = time.time()
+    embedding = QuantizedEmbedding(feature_map, mode, args.sub_num)
+    build_time = time.time() - start
+    result = {'MB': embedding.nbytes() / float(1<<20), 'build (s)': build_time}
+    result['base'] = building[key].evalFeature(embedding.dequantize().numpy())
+
+    num_sample = checkpoint['num_sample'] if checkpoint is not None else args.num_sample
+    gcn = checkpoint['use_gcn'] if checkpoint is not None else args.use_gcn
+    embed_dim = checkpoint['embed_dim'] if checkpoint is not None else feature_map.shape[1]
+    encoder = Encoder(embedding, feature_map.shape[1], embed_dim, adj_lists, num_sample=num_sample, gcn=gcn)
+    propagation = FullGraphPropagation(encoder)
+    result['mean'] = building[key].evalFeature(F.normalize(propagation.aggregated, p=2, dim=1).numpy())
+    if checkpoint is not None:
+        encoder.weight.data.copy_(checkpoint['graph_state_dict']['encoder.weight'])
+        result['new'] = building[key].evalFeature(propagation.encode().t().numpy())
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'mAP and memory of the feature stores on Oxford5k and Paris6k.')
+    parser.add_argument('-m', '--modes', type=str, default='float32,float16,int8,pq', required=False, help='comma separated feature stores, the first one is the reference.')
+    parser.add_argument('-q', '--sub_num', type=int, default=64, required=False, help='number of sub-vectors of pq.')
+    parser.add_argument('-c', '--checkpoint', type=str, default='', required=False, help='checkpoint of main_single to evaluate new features, base features and mean aggregation only if empty.')
+    parser.add_argument('-N', '--num_sample', type=int, default=10, required=False, help='number of neighbors to aggregate.')
+    parser.add_argument('-G', '--use_gcn', type=ast.literal_eval, default=True, required=False, help='whether to use gcn (True) or not (False).')
+    parser.add_argument('-x', '--suffix', type=str, default='.frmac.npy', required=False, help='feature type.')
+    parser.add_argument('-f', '--feat_dim', type=int, default=512, required=False, help='input feature dim of node.')
+    parser.add_argument('-O', '--round', type=int, default=0, required=False, help='round of the test feature maps.')
+    args, _ = parser.parse_known_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu') if args.checkpoint else None
+    modes = args.modes.split(',')
+    for key in building.keys():
+        node_num = test_dataset[key]['node_num']
+        feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix, args.round)
+        results = [evalStore(key, feature_map, adj_lists, mode, args, checkpoint) for mode in modes]
+        columns = ['base', 'mean'] + (['new'] if checkpoint is not None else [])
+
+        print "eval {}, mAP (delta to {})".format(key, modes[0])
+        print "{:>8}  {:>8}  {:>9}  ".format('store', 'MB', 'build (s)') + "  ".join("{:>16}".format(c) for c in columns)
+        for mode, result in zip(modes, results):
+            print "{:>8}  {:>8.1f}  {:>9.1f}  ".format(mode, result['MB'], result['build (s)']) + "  ".join(
+                "{:>7.4f} ({:+.4f})".format(result[c], result[c] - results[0][c]) for c in columns)
+        print ""
@@ -0,0 +1,63 @@
+import torch
+
+import numpy as np
+
+from aggregator import addSelfLoops
+
+class Block(object):
+    '''
+    sampled bipartite graph of one layer, features flow from src_nodes to dst_nodes.
+    dst_nodes are the first dst_num entries of src_nodes, so src features [:dst_num] are the self features.
+    edge k goes from src node cols[k] to dst node rows[k] with weight weights[k] (local indices).
+    '''
+
+    def __init__(self, src_nodes, dst_num, rows, cols, weights):
+        self.src_nodes = src_nodes
+        self.dst_num = dst_num
+        self.rows = rows
+        self.cols = cols
+        self.weights = weights
+
+    @property
+    def dst_nodes(self):
+        return self.src_nodes[:self.dst_num]
+
+    def cuda(self):
+        return Block(self.src_nodes.cuda(non_blocking=True), self.dst_num, self.rows.cuda(non_blocking=True), self.cols.cuda(non_blocking=True), self.weights.cuda(non_blocking=True))
+
+def makeBlock(dst_nodes, neigh_index, neigh_weight, gcn=False):
+    '''
+    dst_nodes: LongTensor of distinct nodes.
+    neigh_index, neigh_weight: padded neighbors of dst_nodes given by NeighborSampler.
+    '''
+    if gcn:
+        neigh_index, neigh_weight = addSelfLoops(dst_nodes, neigh_index, neigh_weight, 1.0)
+    valid = (neigh_index >= 0).numpy()
+    neigh_index, neigh_weight = neigh_index.numpy(), neigh_weight.numpy()
+    rows = np.repeat(np.arange(len(dst_nodes))[:, None], neigh_index.shape[1], axis=1)[valid]
+
+    ## dedupe dst and neighbor nodes, numbered by first appearance so that dst nodes come first
+    all_nodes = np.concatenate((dst_nodes.numpy(), neigh_index[valid]))
+    unique_nodes, first, inverse = np.unique(all_nodes, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='mergesort')
+    local_id = np.empty(len(order), dtype=np.int64)
+    local_id[order] = np.arange(len(order))
+    cols = local_id[inverse[len(dst_nodes):]]
+
+    return Block(torch.from_numpy(unique_nodes[order]), len(dst_nodes), torch.from_numpy(rows), torch.from_numpy(cols), torch.from_numpy(neigh_weight[valid]))
+
+def sampleBlocks(nodes, layers, rng=None):
+    '''
+    plan the computation of a minibatch through stacked Encoder layers.
+    the frontier of each layer is sampled (by the layer's sampler) and deduped once, from the output layer down.
+    nodes: distinct nodes in a batch.
+    return blocks ordered from the input layer to the output layer, blocks[0].src_nodes are the nodes whose raw features are needed.
+    '''
+    dst_nodes = torch.from_numpy(np.asarray(nodes, dtype=np.int64))
+    blocks = []
+    for layer in reversed(layers):
+        neigh_index, neigh_weight = layer.sampler(dst_nodes.numpy(), rng)
+        block = makeBlock(dst_nodes, neigh_index, neigh_weight, layer.gcn)
+        blocks.insert(0, block)
+        dst_nodes = block.src_nodes
+    return blocks
@@ -1,107 +1,113 @@
 import os
-import shutil
-
-from collections import defaultdict
 
 import numpy as np
 
-def removeIsolated(suffix = '.f.npy'):
+from graph import CliqueGraph
+from knn import buildKnnGraph
+
+train_feature_folder = '/path/to/train_feature'
+
+def packedPath(suffix, src_folder = train_feature_folder):
+    return os.path.normpath(src_folder) + '_packed', suffix.split('.')[1]
+
+def packTrainData(suffix = '.f.npy', src_folder = train_feature_folder):
     '''
-    remove isolated points which have no neighbors.
-    return number of nodes and categories.
+    one-time packing of the per-image feature folders (one folder per class) into {key}_feature.npy (node_num x feat_dim),
+    {key}_label.npy (node_num x 1) and {key}_offset.npy (class_num + 1), key being the feature type in suffix.
+    nodes of class c are offset[c]:offset[c+1]. the packed files live next to src_folder.
     '''
-    src_folder = '/path/to/train_feature'
-    class_folders = os.listdir(src_folder)
-    node_num = 0
-    class_num = 0
+    dest_path, key = packedPath(suffix, src_folder)
+    class_folders = sorted(os.listdir(src_folder))
+    features, names, offset = [], [], [0]
     for c, folder in enumerate(class_folders):
         path = os.path.join(src_folder, folder)
-        item_num = len(filter(lambda f: f.endswith(suffix), os.listdir(path)))
-        if item_num > 1:
-            node_num += item_num
-            class_num += 1
-        else:
-            print "remove class-{}".format(c)
-            shutil.rmtree(path)
+        items = sorted(filter(lambda f: f.endswith(suffix), os.listdir(path)))
+        for item in items:
+            features.append(np.load(os.path.join(path, item)).reshape(-1))
+            names.append(os.path.join(folder, item))
+        offset.append(offset[-1] + len(items))
+    offset = np.array(offset, dtype=np.int64)
+    label = np.repeat(np.arange(len(class_folders)), np.diff(offset)).reshape(-1, 1)
+
+    if not os.path.exists(dest_path):
+        os.makedirs(dest_path)
+    np.save(os.path.join(dest_path, key + '_feature.npy'), np.array(features, dtype=np.float32))
+    np.save(os.path.join(dest_path, key + '_label.npy'), label)
+    np.save(os.path.join(dest_path, key + '_offset.npy'), offset)
+    with open(os.path.join(dest_path, key + '_names.txt'), 'w') as fw:
+        fw.write("\n".join(names)+"\n")
+
+def loadTrainData(suffix = '.f.npy', src_folder = train_feature_folder):
+    '''
+    memory-mapped packed training data (feature, label, offset), packed on first use.
+    '''
+    dest_path, key = packedPath(suffix, src_folder)
+    if not os.path.exists(os.path.join(dest_path, key + '_offset.npy')):
+        packTrainData(suffix, src_folder)
+    return [np.load(os.path.join(dest_path, key + name), mmap_mode='r') for name in ['_feature.npy', '_label.npy', '_offset.npy']]
+
+def classMask(offset):
+    '''
+    classes having more than one node, the others are isolated points.
+    '''
+    return np.diff(offset) > 1
+
+def removeIsolated(suffix = '.f.npy', src_folder = train_feature_folder):
+    '''
+    filter out isolated points which have no neighbors (nothing is deleted, see classMask).
+    return number of nodes and categories.
+    '''
+    _, _, offset = loadTrainData(suffix, src_folder)
+    keep = classMask(offset)
+    for c in np.where(~keep)[0]:
+        print "remove class-{}".format(c)
+    node_num = int(np.diff(offset)[keep].sum())
+    class_num = int(keep.sum())
 
     print "node num.:", node_num
     print "class num.:", class_num
 
     return node_num, class_num
 
-def collectGraph_train(node_num, class_num, feat_dim = 256, suffix = '.f.npy'):
+def collectGraph_train(node_num, class_num, feat_dim = 256, suffix = '.f.npy', src_folder = train_feature_folder):
     '''
     (training dataset)
     collect info. about graph including: node, label, feature, neighborhood(adjacent) relationship.
-    neighborhood(adjacent) relationship are constructed based on label.
+    neighborhood(adjacent) relationship are constructed based on label, i.e., every class is a clique (see CliqueGraph).
+    feature_map is the packed memory-mapped feature, returned as is (no row is copied).
+    isolated classes (see classMask) stay in the graph as nodes of degree 0, their nodes have label -1,
+    i.e., training nodes are np.where(label[:, 0] >= 0)[0]. kept classes are relabeled 0, 1, ..., class_num-1.
     '''
 
-    label = np.empty((node_num,1), dtype=np.int64)
-    feature_map = np.zeros((node_num, feat_dim))
-    adj_lists = defaultdict(set)
+    feature, _, offset = loadTrainData(suffix, src_folder)
+    keep = classMask(offset)
+    class_label = np.where(keep, np.cumsum(keep) - 1, -1)
+    label = np.repeat(class_label, np.diff(offset)).reshape(-1, 1)
 
-    src_folder = '/path/to/train_feature'
-    class_folders = os.listdir(src_folder)
-    idx = 0
-    for c, folder in enumerate(class_folders):
-        # print c
-        path = os.path.join(src_folder, folder)
-        # print path
-        items = filter(lambda f: f.endswith(suffix), os.listdir(path))
-        item_num = len(items)
-        for i in range(item_num):
-            item = items[i]
-            ind_i = i + idx
-            feature = np.load(os.path.join(path, item))
-            feature_map[ind_i,:] = feature
-            label[ind_i] = c
-            for j in range(i+1, item_num):
-                ind_j = j + idx
-                adj_lists[ind_i].add(ind_j)
-                adj_lists[ind_j].add(ind_i)
-        idx += item_num
+    return label, feature, CliqueGraph(offset)
 
-    return label, feature_map, adj_lists
-
-def collectGraph_train_v2(node_num, class_num, feat_dim = 256, knn = 10, suffix = '.f.npy', round="0"):
+def collectGraph_train_v2(node_num, class_num, feat_dim = 256, knn = 10, suffix = '.f.npy', round="0", mem_budget = 1<<30, backend = 'exact', data_path = '/path/to', mmap = False):
     '''
     (training dataset)
     collect info. about graph including: node, label, feature, neighborhood(adjacent) relationship.
     neighborhood(adjacent) relationship are constructed based on similarity between features.
+    the kNN graph is built block by block within mem_budget bytes, backend='ivf' for approximate search.
+    data_path holds feature_map_{round}.npy and label.npy, e.g., as written by feature.packRMACfeature.
+    the feature map is memory-mapped instead of loaded if mmap.
     '''
 
-    feature_map = np.load('/path/to/feature_map_{}.npy'.format(round))
-    label = np.load('/path/to/label.npy')
-
-    similarity = np.dot(feature_map, feature_map.T)
-    sort_id = np.argsort(-similarity, axis=1)
-    for n in range(node_num):
-        similarity[n, sort_id[n, knn+1:]] = 0
-        similarity[n] /= np.sum(similarity[n])
-
-    adj_lists = defaultdict(set)
+    feature_map = np.load(os.path.join(data_path, 'feature_map_{}.npy'.format(round)), mmap_mode='r' if mmap else None)
+    label = np.load(os.path.join(data_path, 'label.npy'))
 
-    for n in range(node_num):
-        for k in range(1, knn+1):
-            adj_lists[n].add((sort_id[n,k], similarity[n, sort_id[n][k]]))
+    adj_lists = buildKnnGraph(feature_map, knn, mem_budget, backend)
 
     return label, feature_map, adj_lists
 
-def collectGraph_test(feature_path, node_num, feat_dim = 256, knn = 10, suffix = '.f.npy', round="0"):
+def collectGraph_test(feature_path, node_num, feat_dim = 256, knn = 10, suffix = '.f.npy', round="0", mem_budget = 1<<30, backend = 'exact', mmap = False):
     print "node num.:", node_num
 
-    feature_map = np.load(os.path.join(feature_path, 'feature_map_{}.npy'.format(round)))
-    similarity = np.dot(feature_map, feature_map.T)
-    sort_id = np.argsort(-similarity, axis=1)
-    for n in range(node_num):
-        similarity[n, sort_id[n, knn+1:]] = 0
-        similarity[n] /= np.sum(similarity[n])
-
-    adj_lists = defaultdict(set)
-
-    for n in range(node_num):
-        for k in range(1, knn+1):
-            adj_lists[n].add((sort_id[n,k], similarity[n, sort_id[n][k]]))
+    feature_map = np.load(os.path.join(feature_path, 'feature_map_{}.npy'.format(round)), mmap_mode='r' if mmap else None)
+    adj_lists = buildKnnGraph(feature_map, knn, mem_budget, backend)
 
     return feature_map, adj_lists
 
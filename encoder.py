@@ -1,32 +1,98 @@
 from PACK import *
 
+import numpy as np
+
 # from aggregator import MeanAggregator
 from aggregator_with_weight import MeanAggregator
+from aggregator import meanAggregate
+from block import sampleBlocks
+from feature_store import isFrozen, lookupRows
+from graph import CSRGraph, CliqueGraph
+from sampler import NeighborSampler
 
 class Encoder(nn.Module):
     '''
     encodes a node's embedding using GraphSAGE approach
     '''
 
-    def __init__(self, embedding, feature_dim, embed_dim, adj_lists, num_sample=10, gcn=False, use_cuda=False):
+    def __init__(self, embedding, feature_dim, embed_dim, adj_lists, num_sample=10, gcn=False, use_cuda=False, aggregate_mode='sparse', sampler=None):
+        '''
+        sampler: NeighborSampler over adj_lists, a uniform sampler of num_sample neighbors if None.
+        '''
         super(Encoder, self).__init__()
         self.embedding = embedding
         self.gcn = gcn
         self.use_cuda = use_cuda
         self.feature_dim = feature_dim
         self.embed_dim = embed_dim
-        self.adj_lists = adj_lists
+        self.adj_lists = adj_lists if isinstance(adj_lists, CSRGraph) else CSRGraph.fromAdjLists(adj_lists)
         self.num_sample = num_sample
-        self.aggregator = MeanAggregator(self.embedding, self.gcn, self.use_cuda)
+        self.sampler = sampler if sampler is not None else NeighborSampler(self.adj_lists, num_sample)
+        ## AggregationCache of the frozen embedding, used in place of sampling and aggregation if set
+        self.cache = None
+        ## per-class feature sums of the frozen embedding when adj_lists is a CliqueGraph
+        self.class_sums = None
+        self.aggregator = MeanAggregator(self.embedding, self.gcn, self.use_cuda, aggregate_mode)
 
         self.weight = nn.Parameter(torch.FloatTensor(self.embed_dim, self.feature_dim if self.gcn else 2*self.feature_dim))
         init.xavier_uniform_(self.weight)
 
-    def forward(self, nodes):
+    def prepare(self, nodes, rng=None):
+        '''
+        sampled neighbors of nodes, computed ahead of forward (e.g., by loader.GraphLoader).
+        None if forward does not sample (cached or exact clique aggregation).
+        '''
+        node_ids = np.asarray(nodes, dtype=np.int64)
+        if self.cache is not None or self.exactCliqueMean(node_ids):
+            return None
+        return self.sampler(node_ids, rng)
+
+    def aggregate(self, nodes, rng=None, sample=None):
+        '''
+        mean of features of sampled neighbors of nodes.
+        rng: generator used by the sampler for this batch, see sampler.batchRNG.
+        sample: neighbors given by prepare, sampled here if None.
+        '''
+        node_ids = nodes.cpu().numpy() if type(nodes) == torch.Tensor else np.asarray(nodes, dtype=np.int64)
+        if sample is None and self.exactCliqueMean(node_ids):
+            if self.class_sums is None:
+                self.class_sums = self.frozenClassSums()
+            self_feats = None if self.gcn else self.embedding(torch.from_numpy(node_ids).to(self.class_sums.device))
+            return self.adj_lists.mean(node_ids, self_feats, self.class_sums, self.gcn)
+        neigh_index, neigh_weight = self.sampler(node_ids, rng) if sample is None else sample
+        return self.aggregator.forward(torch.from_numpy(node_ids), neigh_index, neigh_weight)
+
+    def exactCliqueMean(self, node_ids):
+        '''
+        whether the neighbor mean of node_ids can be read from class sums, i.e.,
+        adj_lists is a CliqueGraph, the embedding is frozen and no neighbor is dropped by sampling.
+        '''
+        if not isinstance(self.adj_lists, CliqueGraph) or self.embedding is None or not isFrozen(self.embedding):
+            return False
+        num_sample = self.sampler.num_sample
+        return num_sample is None or len(node_ids) == 0 or self.adj_lists.degree(node_ids).max() <= num_sample
+
+    def frozenClassSums(self, block_size=65536):
+        '''
+        class sums of the frozen embedding, accumulated over blocks of rows looked up from it.
+        '''
+        node_num = len(self.adj_lists)
+        class_sums = None
+        for start in range(0, node_num, block_size):
+            nodes = np.arange(start, min(start + block_size, node_num))
+            block_sums = self.adj_lists.classSums(lookupRows(self.embedding, nodes), nodes)
+            class_sums = block_sums if class_sums is None else class_sums.add_(block_sums)
+        return class_sums
+
+    def forward(self, nodes, rng=None, sample=None):
         '''
         nodes: list of nodes in a batch
+        sample: neighbors of nodes given by prepare, if any.
         '''
-        embedded_features = self.aggregator.forward(nodes, [self.adj_lists[int(node)] for node in nodes], self.num_sample)
+        if self.cache is not None:
+            embedded_features = self.cache(nodes.cpu().numpy() if type(nodes) == torch.Tensor else nodes)
+        else:
+            embedded_features = self.aggregate(nodes, rng, sample)
         if not self.gcn:
             if self.use_cuda:
                 ##
@@ -40,9 +106,64 @@ class Encoder(nn.Module):
                     self_feats = self.embedding(torch.LongTensor(nodes).cuda())
             else:
                 self_feats = self.embedding(torch.LongTensor(nodes))
+        else:
+            self_feats = None
+        return self.combine(self_feats, embedded_features)
+
+    def combine(self, self_feats, embedded_features):
+        if not self.gcn:
             encoding = torch.cat((self_feats, embedded_features), dim=1)
         else:
             encoding = embedded_features
         new_feature = self.weight.mm(encoding.t())
         new_feature = F.normalize(new_feature, p=2, dim=0)
         return new_feature
+
+    def forwardBlock(self, block, src_feats):
+        '''
+        encode the dst nodes of a Block (see block.py).
+        src_feats: features of block.src_nodes, (len(src_nodes) x feature_dim).
+        '''
+        embedded_features = meanAggregate(block.rows, block.cols, block.weights, block.dst_num, src_feats, self.aggregator.mode)
+        return self.combine(src_feats[:block.dst_num], embedded_features)
+
+class MultiLayerEncoder(nn.Module):
+    '''
+    stacked Encoder layers evaluated over sampled blocks.
+    the frontier of all layers is planned once per batch, raw features are gathered once
+    and each layer encodes its whole frontier at once.
+    '''
+
+    def __init__(self, embedding, layers, use_cuda=False):
+        '''
+        (torch.nn.Embedding)
+        embedding is the look up table of raw features of all nodes.
+        layers: list of Encoder, from the input layer to the output layer.
+        '''
+        super(MultiLayerEncoder, self).__init__()
+        self.embedding = embedding
+        self.layers = nn.ModuleList(layers)
+        self.use_cuda = use_cuda
+        self.embed_dim = layers[-1].embed_dim
+
+    def prepare(self, nodes, rng=None):
+        '''
+        sampled blocks of nodes and the position of each node in the deduped batch, computed ahead of forward.
+        '''
+        node_ids = nodes.cpu().numpy() if type(nodes) == torch.Tensor else np.asarray(nodes, dtype=np.int64)
+        unique_nodes, inverse = np.unique(node_ids, return_inverse=True)
+        return sampleBlocks(unique_nodes, self.layers, rng), torch.from_numpy(inverse)
+
+    def forward(self, nodes, rng=None, sample=None):
+        '''
+        nodes: list of nodes in a batch
+        sample: (blocks, inverse) given by prepare, sampled here if None.
+        '''
+        blocks, inverse = self.prepare(nodes, rng) if sample is None else sample
+        if self.use_cuda:
+            blocks = [block.cuda() for block in blocks]
+            inverse = inverse.cuda(non_blocking=True)
+        feats = self.embedding(blocks[0].src_nodes)
+        for layer, block in zip(self.layers, blocks):
+            feats = layer.forwardBlock(block, feats).t()
+        return feats[inverse].t()
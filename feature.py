@@ -4,18 +4,26 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 
 from torchvision import models, transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torchvision.datasets import ImageFolder
+from PIL import Image
 
 import numpy as np
 from sklearn import preprocessing
 from tqdm import tqdm
 import struct
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import os
 import sys
+import argparse
+import ast
+
+from utils import LazyRegistry
+from writer import EmbeddingWriter
 
 img_transform = transforms.Compose([
     transforms.Resize(480),
@@ -25,8 +33,6 @@ img_transform = transforms.Compose([
 
 train_feature_path = "train_feature"
 train_path = "/path/to/landmark_clean"
-train_data = ImageFolder(train_path, transform=img_transform)
-train_dataloader = DataLoader(dataset=train_data, shuffle=False, num_workers=4, batch_size=1)
 
 test_dataset = {
     'oxf': {
@@ -38,14 +44,15 @@ test_dataset = {
         'feature_path': '/path/to/feature',
     }
 }
-test_data_oxf = ImageFolder(test_dataset['oxf']['img_path'], transform=img_transform)
-test_dataloader_oxf = DataLoader(dataset=test_data_oxf, shuffle=False, num_workers=4, batch_size=1)
-test_data_par = ImageFolder(test_dataset['par']['img_path'], transform=img_transform)
-test_dataloader_par = DataLoader(dataset=test_data_par, shuffle=False, num_workers=4, batch_size=1)
-test_dataloader = {
-    'oxf': test_dataloader_oxf,
-    'par': test_dataloader_par,
-}
+
+def makeDataLoader(img_path):
+    return DataLoader(dataset=ImageFolder(img_path, transform=img_transform), shuffle=False, num_workers=4, batch_size=1)
+
+## datasets are scanned on first access
+dataloader = LazyRegistry(
+    [('train', lambda: makeDataLoader(train_path))] +
+    [(key, lambda key=key: makeDataLoader(test_dataset[key]['img_path'])) for key in test_dataset.keys()]
+)
 
 class AlexNetFeature(nn.Module):
     def __init__(self):
@@ -86,6 +93,186 @@ class ResNetFeature(nn.Module):
         f = F.normalize(f, p=2, dim=1)
         return f
 
+backbones = {
+    'alexnet': AlexNetFeature,
+    'vggnet': VGGNetFeature,
+    'resnet': ResNetFeature,
+}
+
+def resizedSize(size, short_side=480):
+    '''
+    (w, h) of an image of the given size after transforms.Resize(short_side).
+    '''
+    w, h = size
+    if (w <= h and w == short_side) or (h <= w and h == short_side):
+        return w, h
+    if w < h:
+        return short_side, int(short_side * h / w)
+    return int(short_side * w / h), short_side
+
+class IndexedImageFolder(Dataset):
+    '''
+    images of ImageFolder (same order), returns (image, index).
+    '''
+
+    def __init__(self, img_path, transform=img_transform):
+        self.folder = ImageFolder(img_path, transform=transform)
+        self.paths = [path for path, _ in self.folder.samples]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.folder[index][0], index
+
+    def resizedSizes(self, indices=None, short_side=480):
+        ## PIL only reads the header here, images are not decoded
+        indices = range(len(self.paths)) if indices is None else indices
+        return [resizedSize(Image.open(self.paths[i]).size, short_side) for i in indices]
+
+class BucketBatchSampler(Sampler):
+    '''
+    batches of images with the same size after resizing, i.e., the same aspect ratio bucket,
+    so that images are batched without padding and give the same features as batch_size=1.
+    '''
+
+    def __init__(self, sizes, batch_size, indices=None):
+        '''
+        sizes: resized size of each image, indices: image index of each entry of sizes (0, 1, ... if None).
+        batches are ordered by the first appearance of their bucket, i.e., deterministic given sizes.
+        '''
+        indices = range(len(sizes)) if indices is None else indices
+        buckets = OrderedDict()
+        for index, size in zip(indices, sizes):
+            buckets.setdefault(size, []).append(index)
+        self.batches = [indices[i:i+batch_size] for indices in buckets.values() for i in range(0, len(indices), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def extractFeatureMap(model, img_path, output_path, batch_size=32, num_workers=4, use_cuda=False):
+    '''
+    extract features of all images under img_path into one (N x D) float32 .npy file (memory-mapped, written in place),
+    together with a manifest (.txt), whose i-th line is the path of the image of the i-th row.
+    images are bucketed by size and batched, decoding runs in num_workers processes and overlaps with compute.
+    '''
+    dataset = IndexedImageFolder(img_path)
+    if len(dataset) == 0:
+        raise ValueError("no image found under {}".format(img_path))
+    batch_sampler = BucketBatchSampler(dataset.resizedSizes(), batch_size)
+    data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers, pin_memory=use_cuda)
+
+    if use_cuda:
+        model.cuda()
+    model.eval()
+    feature_map = None
+    with torch.no_grad():
+        for img, index in tqdm(data_loader):
+            if use_cuda:
+                img = img.cuda(non_blocking=True)
+            feature = model(img).cpu().numpy()
+            if feature_map is None:
+                feature_map = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(len(dataset), feature.shape[1]))
+            feature_map[index.numpy()] = feature
+    feature_map.flush()
+
+    with open(os.path.splitext(output_path)[0] + '.txt', 'w') as fw:
+        fw.write("\n".join(dataset.paths)+"\n")
+    return feature_map
+
+_shard_models = {}
+
+def readProgress(progress_path):
+    if not os.path.exists(progress_path):
+        return 0
+    return int(open(progress_path).read().strip() or 0)
+
+def writeProgress(progress_path, batch_done):
+    ## atomic, a killed job never leaves a watermark ahead of the flushed features
+    with open(progress_path + '.tmp', 'w') as fw:
+        fw.write(str(batch_done))
+    os.rename(progress_path + '.tmp', progress_path)
+
+def extractShard(shard_args):
+    '''
+    extract features of images [start, end) into shard_dir/shard_{shard}.npy.
+    the number of finished batches is kept in shard_{shard}.progress, a restarted shard resumes from it.
+    '''
+    model_name, img_path, shard_dir, shard, start, end, batch_size, use_cuda = shard_args
+    dataset = IndexedImageFolder(img_path)
+    indices = range(start, end)
+    batches = BucketBatchSampler(dataset.resizedSizes(indices), batch_size, indices).batches
+    shard_path = os.path.join(shard_dir, 'shard_{}.npy'.format(shard))
+    progress_path = os.path.join(shard_dir, 'shard_{}.progress'.format(shard))
+    batch_done = readProgress(progress_path)
+    if batch_done >= len(batches):
+        return shard
+
+    if model_name not in _shard_models:
+        _shard_models[model_name] = backbones[model_name]()
+    model = _shard_models[model_name]
+    if use_cuda:
+        model.cuda()
+    model.eval()
+    feature_map = np.load(shard_path, mmap_mode='r+') if batch_done > 0 else None
+    ## shard workers are daemonic processes, images are decoded in-process
+    data_loader = DataLoader(dataset, batch_sampler=batches[batch_done:], num_workers=0, pin_memory=use_cuda)
+    with torch.no_grad():
+        for img, index in data_loader:
+            if use_cuda:
+                img = img.cuda(non_blocking=True)
+            feature = model(img).cpu().numpy()
+            if feature_map is None:
+                feature_map = np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.float32, shape=(end - start, feature.shape[1]))
+            feature_map[index.numpy() - start] = feature
+            feature_map.flush()
+            batch_done += 1
+            writeProgress(progress_path, batch_done)
+    return shard
+
+def extractFeatureMapSharded(model_name, img_path, output_path, shard_size=4096, processes=2, batch_size=32, use_cuda=False):
+    '''
+    resumable version of extractFeatureMap: images are split into shards of shard_size by index,
+    shards are extracted by processes workers and merged into output_path (and its .txt manifest) at the end.
+    rerunning after a failure skips finished shards and resumes unfinished ones.
+    '''
+    paths = IndexedImageFolder(img_path).paths
+    image_num = len(paths)
+    if image_num == 0:
+        raise ValueError("no image found under {}".format(img_path))
+    shard_dir = output_path + '.shards'
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    plan = "{} {} {} {}".format(model_name, image_num, shard_size, batch_size)
+    plan_path = os.path.join(shard_dir, 'plan.txt')
+    if os.path.exists(plan_path) and open(plan_path).read().strip() != plan:
+        raise ValueError("{} holds shards of another extraction ({}), remove it to restart.".format(shard_dir, open(plan_path).read().strip()))
+    with open(plan_path, 'w') as fw:
+        fw.write(plan)
+
+    shards = [(model_name, img_path, shard_dir, s, start, min(start + shard_size, image_num), batch_size, use_cuda)
+            for s, start in enumerate(range(0, image_num, shard_size))]
+    pool = multiprocessing.Pool(processes)
+    for shard in tqdm(pool.imap_unordered(extractShard, shards), total=len(shards)):
+        pass
+    pool.close()
+    pool.join()
+
+    ## merge
+    feature_map = None
+    for _, _, _, s, start, end, _, _ in shards:
+        shard_map = np.load(os.path.join(shard_dir, 'shard_{}.npy'.format(s)), mmap_mode='r')
+        if feature_map is None:
+            feature_map = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(image_num, shard_map.shape[1]))
+        feature_map[start:end] = shard_map
+    feature_map.flush()
+    with open(os.path.splitext(output_path)[0] + '.txt', 'w') as fw:
+        fw.write("\n".join(paths)+"\n")
+    return feature_map
+
 def extractFeature(model, data_loader, feature_path, write_flag=False, suffix='.f.npy'):
     '''
     write feature to .npy file or return feature matrix.
@@ -106,13 +293,12 @@ def extractFeature(model, data_loader, feature_path, write_flag=False, suffix='.
             np.save(save_dir, feature.cpu().data.numpy())
             cnt += 1
     else:
-        feature_map = torch.FloatTensor()
+        writer = EmbeddingWriter(len(data_loader.dataset))
         for img, _ in tqdm(data_loader):
             img = Variable(img).cuda()
             feature = model(img)
-            feature_map = torch.cat((feature_map, feature.cpu().data), 0)
-        feature_map = feature_map.numpy()
-        return feature_map
+            writer.write(feature)
+        return writer.finish()
 
 def proceeRMACfeature(img_path, src_path, dest_path):
     '''
@@ -146,7 +332,68 @@ def proceeRMACfeature(img_path, src_path, dest_path):
             cnt += 1
     print "number of features:", cnt
 
+def readDescriptor(src_feature, byte_num):
+    with open(src_feature, 'rb') as fr:
+        return fr.read(byte_num)
+
+def packRMACfeature(img_path, src_path, dest_path, round=0, threads=8, feat_dim=512):
+    '''
+    bulk version of proceeRMACfeature: rmac halves of all vgg16_rmac descriptors are read at once (file reads in a thread pool),
+    l2-normalized as one matrix and written to dest_path/feature_map_{round}.npy, a contiguous (N x feat_dim) float32 array,
+    together with the name index (feature_map_{round}.txt, "folder/image" per row) and dest_path/label.npy,
+    i.e., the inputs of collectGraph_train_v2(..., data_path=dest_path).
+    '''
+    names, labels, src_features = [], [], []
+    for c, folder in enumerate(sorted(os.listdir(img_path))):
+        for img in sorted(os.listdir(os.path.join(img_path, folder))):
+            src_feature = os.path.join(src_path, img+'.vgg16_rmac')
+            if os.path.exists(src_feature):
+                names.append(os.path.join(folder, img))
+                labels.append(c)
+                src_features.append(src_feature)
+
+    ## max-pooling feature and rmac feature are stored back to back
+    byte_num = 2*4*feat_dim
+    pool = ThreadPool(threads)
+    buffers = pool.map(lambda src_feature: readDescriptor(src_feature, byte_num), src_features)
+    pool.close()
+    pool.join()
+    ## a truncated file would shift all following rows against names and labels
+    truncated = [(src_feature, len(buf)) for src_feature, buf in zip(src_features, buffers) if len(buf) != byte_num]
+    if truncated:
+        raise ValueError("{} truncated descriptors (expected {} bytes), e.g., {} ({} bytes)".format(len(truncated), byte_num, *truncated[0]))
+    feature_map = np.frombuffer(b''.join(buffers), dtype=np.float32).reshape(-1, 2, feat_dim)[:, 1]
+    norm = np.linalg.norm(feature_map, axis=1, keepdims=True)
+    norm[norm == 0] = 1.0
+    feature_map = np.ascontiguousarray(feature_map / norm, dtype=np.float32)
+
+    if not os.path.exists(dest_path):
+        os.makedirs(dest_path)
+    output_path = os.path.join(dest_path, 'feature_map_{}.npy'.format(round))
+    np.save(output_path, feature_map)
+    np.save(os.path.join(dest_path, 'label.npy'), np.array(labels, dtype=np.int64).reshape(-1, 1))
+    with open(os.path.splitext(output_path)[0] + '.txt', 'w') as fw:
+        fw.write("\n".join(names)+"\n")
+    print "number of features:", len(names)
+    return feature_map
+
 if __name__ == "__main__":
-    model, suffix = AlexNetFeature(), '.f.npy'
-    for building, building_dataloader in test_dataloader.items():
-        extractFeature(model, building_dataloader, test_dataset[building]['feature_path'], True, suffix)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Extract features of test datasets into feature_map_{round}.npy.')
+    parser.add_argument('-m', '--model', type=str, default='alexnet', required=False, help='backbone, \'alexnet\', \'vggnet\' or \'resnet\'.')
+    parser.add_argument('-B', '--batch_size', type=int, default=32, required=False, help='extraction batch size.')
+    parser.add_argument('-w', '--num_workers', type=int, default=4, required=False, help='number of image decoding workers.')
+    parser.add_argument('-C', '--use_cuda', type=ast.literal_eval, default=False, required=False, help='whether to use gpu (True) or not (False).')
+    parser.add_argument('-O', '--round', type=int, default=0, required=False, help='round of the feature map.')
+    parser.add_argument('-d', '--dataset', type=str, default='oxf,par', required=False, help='comma separated datasets to extract, among \'train\', \'oxf\' and \'par\'.')
+    parser.add_argument('-s', '--shard_size', type=int, default=0, required=False, help='number of images per shard for resumable extraction, 0 for no sharding.')
+    parser.add_argument('-p', '--processes', type=int, default=2, required=False, help='number of shard worker processes.')
+    args, _ = parser.parse_known_args()
+
+    for key in args.dataset.split(','):
+        img_path = train_path if key == 'train' else test_dataset[key]['img_path']
+        feature_path = train_feature_path if key == 'train' else test_dataset[key]['feature_path']
+        output_path = os.path.join(feature_path, 'feature_map_{}.npy'.format(args.round))
+        if args.shard_size > 0:
+            extractFeatureMapSharded(args.model, img_path, output_path, args.shard_size, args.processes, args.batch_size, args.use_cuda)
+        else:
+            extractFeatureMap(backbones[args.model](), img_path, output_path, args.batch_size, args.num_workers, args.use_cuda)
\ No newline at end of file
@@ -0,0 +1,212 @@
+from PACK import *
+
+import numpy as np
+
+def kmeans(x, k, niter=20, seed=0):
+    '''
+    euclidean k-means (Lloyd), return (k x dim) centroids.
+    '''
+    rng = np.random.RandomState(seed)
+    k = min(k, x.shape[0])
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    for _ in range(niter):
+        assign = nearestCentroid(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        ## re-seed empty clusters from random samples
+        empty = counts == 0
+        sums[empty] = x[rng.choice(x.shape[0], int(empty.sum()), replace=False)]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids
+
+def nearestCentroid(x, centroids, batch_size=65536):
+    assign = np.empty(x.shape[0], dtype=np.int64)
+    c_norm = np.sum(centroids**2, axis=1)
+    for start in range(0, x.shape[0], batch_size):
+        assign[start:start+batch_size] = np.argmin(c_norm - 2 * x[start:start+batch_size].dot(centroids.T), axis=1)
+    return assign
+
+class QuantizedEmbedding(nn.Module):
+    '''
+    frozen node features stored in reduced precision, in place of nn.Embedding with requires_grad=False:
+    calling it with LongTensor node ids dequantizes only the gathered rows.
+    mode='float32': no compression,
+    mode='float16': half precision,
+    mode='int8': int8 codes with a per-row scale,
+    mode='pq': product quantization, each of sub_num sub-vectors coded by one byte (256 centroids).
+    '''
+
+    def __init__(self, feature_map, mode='float16', sub_num=64, train_num=65536, niter=20, seed=0):
+        super(QuantizedEmbedding, self).__init__()
+        feature_map = np.asarray(feature_map, dtype=np.float32)
+        self.mode = mode
+        self.num_embeddings, self.embedding_dim = feature_map.shape
+        if mode == 'float32':
+            self.register_buffer('data', torch.from_numpy(feature_map))
+        elif mode == 'float16':
+            self.register_buffer('data', torch.from_numpy(feature_map.astype(np.float16)))
+        elif mode == 'int8':
+            scale = np.abs(feature_map).max(axis=1, keepdims=True) / 127.0
+            scale[scale == 0] = 1.0
+            self.register_buffer('codes', torch.from_numpy(np.round(feature_map / scale).astype(np.int8)))
+            self.register_buffer('scale', torch.from_numpy(scale.astype(np.float32)))
+        elif mode == 'pq':
+            if self.embedding_dim % sub_num != 0:
+                raise ValueError("feature dim {} is not divisible by {} sub-vectors".format(self.embedding_dim, sub_num))
+            rng = np.random.RandomState(seed)
+            sample = feature_map[rng.choice(self.num_embeddings, min(train_num, self.num_embeddings), replace=False)]
+            sub_dim = self.embedding_dim // sub_num
+            codebooks = np.zeros((sub_num, 256, sub_dim), dtype=np.float32)
+            codes = np.empty((self.num_embeddings, sub_num), dtype=np.uint8)
+            for m in range(sub_num):
+                sub = slice(m*sub_dim, (m+1)*sub_dim)
+                centroids = kmeans(sample[:, sub], 256, niter, seed + m)
+                codebooks[m, :len(centroids)] = centroids
+                codes[:, m] = nearestCentroid(feature_map[:, sub], centroids)
+            self.register_buffer('codes', torch.from_numpy(codes))
+            self.register_buffer('codebooks', torch.from_numpy(codebooks))
+        else:
+            raise ValueError("unknown feature store mode: {}".format(mode))
+
+    def forward(self, nodes):
+        '''
+        nodes: LongTensor of node ids, return (len(nodes) x embedding_dim) FloatTensor.
+        '''
+        nodes = nodes.to(next(self.buffers()).device)
+        if self.mode == 'float32':
+            return self.data[nodes]
+        elif self.mode == 'float16':
+            return self.data[nodes].float()
+        elif self.mode == 'int8':
+            return self.codes[nodes].float() * self.scale[nodes]
+        codes = self.codes[nodes].long()
+        sub_num = codes.size(1)
+        sub_index = torch.arange(sub_num, device=codes.device).view(1, -1).expand_as(codes)
+        return self.codebooks[sub_index, codes].view(-1, self.embedding_dim)
+
+    def dequantize(self):
+        '''
+        all dequantized features, (num_embeddings x embedding_dim) float32, e.g., to evaluate the store itself.
+        there is no weight: full-graph code paths look up rows block by block (see propagate.aggregateRows).
+        '''
+        return self.forward(torch.arange(self.num_embeddings))
+
+    def nbytes(self):
+        return sum(buf.numel() * buf.element_size() for buf in self.buffers())
+
+class MemmapEmbedding(nn.Module):
+    '''
+    frozen node features read from a .npy file on demand (np.load with mmap_mode='r'), in place of nn.Embedding
+    for feature maps larger than memory. the rows of a batch are deduped and read in sorted order, rows at most
+    coalesce_gap apart are read as one contiguous slice. recently used rows are kept in an LRU cache of cache_rows rows.
+    hits and misses count cached and read rows. there is no weight, the file is never loaded as a whole:
+    full-graph code paths look up rows block by block (see propagate.aggregateRows).
+    '''
+
+    def __init__(self, feature_map, cache_rows=65536, coalesce_gap=16):
+        '''
+        feature_map: path of a .npy file or a np.memmap.
+        '''
+        super(MemmapEmbedding, self).__init__()
+        self.features = feature_map if isinstance(feature_map, np.memmap) else np.load(feature_map, mmap_mode='r')
+        self.num_embeddings, self.embedding_dim = self.features.shape
+        self.coalesce_gap = coalesce_gap
+        self.use_cuda = False
+
+        cache_rows = min(cache_rows, self.num_embeddings)
+        self.cache = np.empty((cache_rows, self.embedding_dim), dtype=np.float32)
+        self.slot_of = np.full(self.num_embeddings, -1, dtype=np.int64)
+        self.row_of = np.full(cache_rows, -1, dtype=np.int64)
+        self.last_used = np.full(cache_rows, -1, dtype=np.int64)
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def cuda(self, device=None):
+        self.use_cuda = True
+        return super(MemmapEmbedding, self).cuda(device)
+
+    def cpu(self):
+        self.use_cuda = False
+        return super(MemmapEmbedding, self).cpu()
+
+    def read(self, rows):
+        '''
+        rows: sorted distinct row ids, one slice read per run of rows closer than coalesce_gap.
+        '''
+        out = np.empty((len(rows), self.embedding_dim), dtype=np.float32)
+        breaks = np.where(np.diff(rows) > self.coalesce_gap)[0] + 1
+        for start, end in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(rows)]))):
+            first, last = rows[start], rows[end-1]
+            out[start:end] = self.features[first:last+1][rows[start:end] - first]
+        return out
+
+    def lookup(self, rows):
+        '''
+        features of sorted distinct rows, through the LRU cache.
+        '''
+        self.tick += 1
+        slots = self.slot_of[rows]
+        hit = slots >= 0
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+        self.last_used[slots[hit]] = self.tick
+
+        out = np.empty((len(rows), self.embedding_dim), dtype=np.float32)
+        out[hit] = self.cache[slots[hit]]
+        miss = np.where(~hit)[0]
+        if len(miss) > 0:
+            out[miss] = self.read(rows[miss])
+            ## evict the least recently used (or empty) slots, rows of this batch are kept
+            stale = np.where(self.last_used < self.tick)[0]
+            keep = min(len(miss), len(stale))
+            victims = stale[np.argpartition(self.last_used[stale], keep - 1)[:keep]] if keep > 0 else stale[:0]
+            evicted = self.row_of[victims]
+            self.slot_of[evicted[evicted >= 0]] = -1
+            self.row_of[victims] = rows[miss[:keep]]
+            self.slot_of[rows[miss[:keep]]] = victims
+            self.last_used[victims] = self.tick
+            self.cache[victims] = out[miss[:keep]]
+        return out
+
+    def forward(self, nodes):
+        '''
+        nodes: LongTensor of node ids, return (len(nodes) x embedding_dim) FloatTensor.
+        '''
+        unique_nodes, inverse = np.unique(nodes.cpu().numpy(), return_inverse=True)
+        features = torch.from_numpy(self.lookup(unique_nodes)[inverse])
+        return features.cuda() if self.use_cuda else features
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / float(total)}
+
+def isFrozen(embedding):
+    '''
+    whether the node features of embedding are fixed, without reading its table.
+    '''
+    return isinstance(embedding, (QuantizedEmbedding, MemmapEmbedding)) or not embedding.weight.requires_grad
+
+def lookupRows(embedding, nodes):
+    '''
+    features of nodes (array of node ids) from nn.Embedding or a feature store, on the device of embedding.
+    '''
+    index = torch.from_numpy(np.asarray(nodes, dtype=np.int64))
+    if isinstance(embedding, nn.Embedding):
+        index = index.to(embedding.weight.device)
+    return embedding(index)
+
+def makeEmbedding(feature_map, store='float32'):
+    '''
+    frozen feature embedding of nodes, nn.Embedding for float32, MemmapEmbedding for mmap (feature_map being a np.memmap),
+    QuantizedEmbedding otherwise.
+    '''
+    if store == 'mmap':
+        return MemmapEmbedding(feature_map)
+    if store != 'float32':
+        return QuantizedEmbedding(feature_map, store)
+    embedding = nn.Embedding(feature_map.shape[0], feature_map.shape[1])
+    embedding.weight = nn.Parameter(torch.from_numpy(np.asarray(feature_map)).float(), requires_grad=False)
+    return embedding
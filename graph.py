@@ -0,0 +1,218 @@
+import torch
+
+import numpy as np
+
+def cliqueNeighbors(start, position, degree):
+    '''
+    CSR rows whose neighbors are the cliques start[i]:start[i]+degree[i]+1 without their own node start[i]+position[i].
+    '''
+    indptr = np.concatenate(([0], np.cumsum(degree)))
+    rows = np.repeat(np.arange(len(degree)), degree)
+    rank = np.arange(indptr[-1]) - indptr[rows]
+    ## the rank-th neighbor of a node skips the node itself
+    return indptr, start[rows] + rank + (rank >= position[rows])
+
+class CSRGraph(object):
+    '''
+    compact adjacency relationship in compressed sparse row format.
+    neighbors of node n are indices[indptr[n]:indptr[n+1]], the corresponding edge weights are weights[indptr[n]:indptr[n+1]].
+    weighted=False for graphs without edge weights (all weights are 1).
+    '''
+
+    def __init__(self, indptr, indices, weights=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weighted = weights is not None
+        if weights is None:
+            weights = np.ones(len(self.indices), dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+
+    @classmethod
+    def fromAdjLists(cls, adj_lists, node_num=None):
+        '''
+        convert the set-based form, i.e., dict of sets of node or (node, weight).
+        '''
+        if node_num is None:
+            node_num = max(adj_lists.keys()) + 1 if len(adj_lists) > 0 else 0
+        return cls.fromNeighborSets([adj_lists.get(n, ()) for n in range(node_num)])
+
+    @classmethod
+    def fromNeighborSets(cls, neighbors):
+        '''
+        build a graph whose i-th row is neighbors[i], a set of node or (node, weight).
+        '''
+        degree = [len(neigh) for neigh in neighbors]
+        indptr = np.concatenate(([0], np.cumsum(degree, dtype=np.int64)))
+        edges = [edge for neigh in neighbors for edge in sorted(neigh)]
+        if len(edges) > 0 and isinstance(edges[0], tuple):
+            indices = [edge[0] for edge in edges]
+            weights = [edge[1] for edge in edges]
+            return cls(indptr, indices, weights)
+        return cls(indptr, edges)
+
+    @classmethod
+    def fromKnn(cls, sort_id, weight):
+        '''
+        build a graph from (node_num x k) neighbor ids and weights, negative ids are missing neighbors.
+        '''
+        valid = sort_id >= 0
+        indptr = np.concatenate(([0], np.cumsum(np.sum(valid, axis=1), dtype=np.int64)))
+        return cls(indptr, sort_id[valid], weight[valid])
+
+    @classmethod
+    def fromCliques(cls, offsets):
+        '''
+        build the graph in which nodes offsets[c]:offsets[c+1] form a clique (without self-loops), e.g., one clique per class.
+        '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sizes = np.diff(offsets)
+        start = np.repeat(offsets[:-1], sizes)
+        return cls(*cliqueNeighbors(start, np.arange(offsets[-1]) - start, np.maximum(sizes - 1, 0)[np.repeat(np.arange(len(sizes)), sizes)]))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def node_num(self):
+        return len(self)
+
+    @property
+    def edge_num(self):
+        return len(self.indices)
+
+    def degree(self, nodes=None):
+        degree = np.diff(self.indptr)
+        return degree if nodes is None else degree[np.asarray(nodes, dtype=np.int64)]
+
+    def neighbors(self, node):
+        start, end = self.indptr[node], self.indptr[node+1]
+        return self.indices[start:end], self.weights[start:end]
+
+    def __getitem__(self, node):
+        '''
+        compatibility with the set-based form.
+        '''
+        indices, weights = self.neighbors(int(node))
+        if self.weighted:
+            return set(zip(indices.tolist(), weights.tolist()))
+        return set(indices.tolist())
+
+    def batch(self, nodes):
+        '''
+        sub-graph whose i-th row holds the neighbors of nodes[i], gathered by slicing.
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64).ravel()
+        start = self.indptr[nodes]
+        degree = self.indptr[nodes+1] - start
+        indptr = np.concatenate(([0], np.cumsum(degree)))
+        position = np.repeat(start - indptr[:-1], degree) + np.arange(indptr[-1])
+        return CSRGraph(indptr, self.indices[position], self.weights[position] if self.weighted else None)
+
+    def rows(self):
+        '''
+        row id of each edge.
+        '''
+        return np.repeat(np.arange(len(self)), self.degree())
+
+class CliqueGraph(CSRGraph):
+    '''
+    graph in which nodes offsets[c]:offsets[c+1] form a clique, e.g., images of the same class,
+    i.e., the neighbors of a node are the other nodes of its class. only class offsets are stored,
+    neighbor sampling and the exact neighbor mean (from per-class feature sums) cost O(1) per node.
+    CSR arrays (indptr, indices, weights) are materialized on first access, for full-graph code paths only.
+    '''
+
+    def __init__(self, offsets):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sizes = np.diff(self.offsets)
+        self.label = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        self.weighted = False
+        self._csr = None
+
+    @property
+    def csr(self):
+        if self._csr is None:
+            self._csr = CSRGraph.fromCliques(self.offsets)
+        return self._csr
+
+    @property
+    def indptr(self):
+        return self.csr.indptr
+
+    @property
+    def indices(self):
+        return self.csr.indices
+
+    @property
+    def weights(self):
+        return self.csr.weights
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def edge_num(self):
+        return int(np.sum(self.sizes * np.maximum(self.sizes - 1, 0)))
+
+    def degree(self, nodes=None):
+        degree = np.maximum(self.sizes - 1, 0)
+        return degree[self.label] if nodes is None else degree[self.label[np.asarray(nodes, dtype=np.int64)]]
+
+    def neighbors(self, node):
+        c = self.label[node]
+        indices = np.arange(self.offsets[c], self.offsets[c+1], dtype=np.int32)
+        indices = indices[indices != node]
+        return indices, np.ones(len(indices), dtype=np.float32)
+
+    def batch(self, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64).ravel()
+        start = self.offsets[self.label[nodes]]
+        indptr, indices = cliqueNeighbors(start, nodes - start, self.degree(nodes))
+        return CSRGraph(indptr, indices)
+
+    def sample(self, nodes, num_sample, rng):
+        '''
+        uniform sampling without replacement, in the (index, weight) format of NeighborSampler.
+        samples follow the same distribution as NeighborSampler over the explicit graph, not the same draws.
+        each row draws num_sample ranks among its degree neighbors by Floyd's algorithm, vectorized over rows.
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64).ravel()
+        degree = self.degree(nodes)
+        max_degree = int(degree.max()) if len(degree) > 0 else 0
+        k = max_degree if num_sample is None else min(num_sample, max_degree)
+
+        rank = np.tile(np.arange(k), (len(nodes), 1))
+        rank[rank >= degree[:, None]] = -1
+        sampled = np.where(degree > k)[0]
+        if len(sampled) > 0:
+            m = degree[sampled]
+            for i in range(k):
+                j = m - k + i
+                t = (rng.random_sample(len(sampled)) * (j + 1)).astype(np.int64)
+                dup = (rank[sampled, :i] == t[:, None]).any(axis=1)
+                rank[sampled, i] = np.where(dup, j, t)
+
+        start = self.offsets[self.label[nodes]][:, None]
+        neigh_index = start + rank + (rank >= nodes[:, None] - start)
+        neigh_index[rank < 0] = -1
+        neigh_weight = (rank >= 0).astype(np.float32)
+        return torch.from_numpy(neigh_index), torch.from_numpy(neigh_weight)
+
+    def classSums(self, features, nodes=None):
+        '''
+        per-class sums of features (node_num x feature_dim FloatTensor), (class_num x feature_dim).
+        nodes: the nodes of the rows of features, all nodes if None.
+        '''
+        label = torch.from_numpy(self.label if nodes is None else self.label[nodes]).to(features.device)
+        return torch.zeros(len(self.sizes), features.size(1), dtype=features.dtype, device=features.device).index_add_(0, label, features)
+
+    def mean(self, nodes, self_feats, class_sums, gcn=False):
+        '''
+        exact mean of neighbor features of nodes, the node itself (features self_feats) is left out of its class sum unless gcn.
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        label = torch.from_numpy(self.label[nodes]).to(class_sums.device)
+        sizes = torch.from_numpy(self.sizes[self.label[nodes]]).to(class_sums.device).float().view(-1, 1)
+        if gcn:
+            return class_sums[label] / sizes
+        return (class_sums[label] - self_feats) / torch.clamp(sizes - 1, min=1)
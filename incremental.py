@@ -0,0 +1,169 @@
+from PACK import *
+
+import numpy as np
+
+from encoder import MultiLayerEncoder
+from graph import CSRGraph
+from knn import blockRows, topK, knnSearch
+from propagate import adjacencyMatrix
+
+def growRows(buffer, capacity, row_num):
+    '''
+    a buffer (np.ndarray or torch.Tensor) of capacity rows holding the first row_num rows of buffer.
+    '''
+    if isinstance(buffer, torch.Tensor):
+        grown = buffer.new_empty((capacity,) + tuple(buffer.shape[1:]))
+    else:
+        grown = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:row_num] = buffer[:row_num]
+    return grown
+
+class IncrementalGraph(object):
+    '''
+    kNN graph and encoded features of a database that grows by insertion, without full rebuilds.
+    the ranked neighbors (self included) of every node are kept, so that a new row only costs
+    its own kNN search and one similarity column per existing node. existing nodes whose kNN list
+    changed are patched, and only the nodes whose (multi-hop) neighborhood changed are re-encoded.
+    rows live in buffers whose capacity doubles, the CSR graph has knn edges per row and only
+    the rows of changed nodes are rewritten, i.e., an insertion does not copy the index.
+    graph and features match buildKnnGraph with backend='exact' and FullGraphPropagation over all rows
+    (up to ties in similarity). the trained weights of encoder are used, not its graph or embedding.
+    '''
+
+    def __init__(self, feature_map, encoder, knn=10, mem_budget=1<<30):
+        '''
+        encoder: Encoder or MultiLayerEncoder.
+        '''
+        self.knn = knn
+        self.mem_budget = mem_budget
+        self.layers = list(encoder.layers) if isinstance(encoder, MultiLayerEncoder) else [encoder]
+        features = np.ascontiguousarray(feature_map, dtype=np.float32)
+        if features.shape[0] <= knn:
+            raise ValueError("{} nodes cannot have {} neighbors each".format(features.shape[0], knn))
+        self.node_num = features.shape[0]
+        self.capacity = self.node_num
+        self._features = features
+        self._sort_id, self._sort_sim = knnSearch(features, features, knn+1, mem_budget)
+        ## CSR arrays with knn edges per row, rows are patched in place
+        self._indptr = np.arange(self.capacity + 1, dtype=np.int64) * knn
+        self._indices = np.empty((self.capacity, knn), dtype=np.int32)
+        self._weights = np.empty((self.capacity, knn), dtype=np.float32)
+        self.patchRows(np.arange(self.node_num))
+
+        ## outputs of each layer, (capacity x embed_dim)
+        self._encoded = []
+        with torch.no_grad():
+            feats = torch.from_numpy(self.features)
+            for layer in self.layers:
+                feats = layer.combine(feats, torch.sparse.mm(adjacencyMatrix(self.graph, layer.gcn), feats)).t().contiguous()
+                self._encoded.append(feats)
+
+    def __len__(self):
+        return self.node_num
+
+    @property
+    def features(self):
+        return self._features[:self.node_num]
+
+    @property
+    def sort_id(self):
+        return self._sort_id[:self.node_num]
+
+    @property
+    def sort_sim(self):
+        return self._sort_sim[:self.node_num]
+
+    @property
+    def graph(self):
+        '''
+        CSRGraph over the current rows, a view of the buffers.
+        '''
+        return CSRGraph(self._indptr[:self.node_num+1], self._indices[:self.node_num].reshape(-1), self._weights[:self.node_num].reshape(-1))
+
+    @property
+    def encoded(self):
+        return [encoded[:self.node_num] for encoded in self._encoded]
+
+    @property
+    def feature_map(self):
+        '''
+        new features of all nodes, (node_num x embed_dim).
+        '''
+        return self._encoded[-1][:self.node_num].numpy()
+
+    def patchRows(self, nodes):
+        '''
+        rewrite the CSR rows of nodes from their ranked neighbors, with the edge weights of knn.knnGraph.
+        '''
+        sort_sim = self._sort_sim[nodes]
+        self._indices[nodes] = self._sort_id[nodes, 1:]
+        self._weights[nodes] = (sort_sim / np.sum(sort_sim, axis=1, keepdims=True))[:, 1:]
+
+    def reserve(self, node_num):
+        '''
+        grow the buffers to hold node_num rows, the capacity doubles so that rows are copied O(1) times on average.
+        '''
+        if node_num <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < node_num:
+            capacity *= 2
+        self._features = growRows(self._features, capacity, self.node_num)
+        self._sort_id = growRows(self._sort_id, capacity, self.node_num)
+        self._sort_sim = growRows(self._sort_sim, capacity, self.node_num)
+        self._indices = growRows(self._indices, capacity, self.node_num)
+        self._weights = growRows(self._weights, capacity, self.node_num)
+        self._indptr = np.arange(capacity + 1, dtype=np.int64) * self.knn
+        self._encoded = [growRows(encoded, capacity, self.node_num) for encoded in self._encoded]
+        self.capacity = capacity
+
+    def insert(self, new_features):
+        '''
+        append rows new_features (new_num x feat_dim), return the nodes that were re-encoded.
+        '''
+        new_features = np.ascontiguousarray(new_features, dtype=np.float32)
+        old_num, new_num = len(self), new_features.shape[0]
+        self.reserve(old_num + new_num)
+        self._features[old_num:old_num+new_num] = new_features
+        self.node_num = old_num + new_num
+
+        ## kNN of new rows among all rows
+        new_nodes = np.arange(old_num, old_num + new_num)
+        self._sort_id[new_nodes], self._sort_sim[new_nodes] = knnSearch(new_features, self.features, self.knn+1, self.mem_budget)
+
+        ## existing rows take a new row in when it beats their last neighbor
+        block = blockRows(new_num + self.knn + 1, self.mem_budget, 4)
+        changed = []
+        for start in range(0, old_num, block):
+            end = min(start + block, old_num)
+            similarity = np.dot(self._features[start:end], new_features.T)
+            rows = np.where(similarity.max(axis=1) > self._sort_sim[start:end, -1])[0]
+            if len(rows) == 0:
+                continue
+            cand_id = np.concatenate((self._sort_id[start+rows], np.tile(new_nodes, (len(rows), 1))), axis=1)
+            cand_sim = np.concatenate((self._sort_sim[start+rows], similarity[rows]), axis=1)
+            top_id, top_sim = topK(cand_sim, self.knn+1)
+            index = np.arange(len(rows))[:, None]
+            self._sort_id[start+rows], self._sort_sim[start+rows] = cand_id[index, top_id], top_sim
+            changed.append(start + rows)
+        changed = np.concatenate(changed + [new_nodes])
+        self.patchRows(changed)
+        graph = self.graph
+
+        ## re-encode layer by layer, a node is dirty if its neighbors changed or one of its neighbors is dirty in the layer below
+        dirty = changed
+        dirty_prev = new_nodes
+        with torch.no_grad():
+            feats = torch.from_numpy(self.features)
+            for l, layer in enumerate(self.layers):
+                if l > 0:
+                    ## rows holding a dirty neighbor, every row has knn edges
+                    touched = np.flatnonzero(np.isin(graph.indices, dirty_prev)) // self.knn
+                    dirty = np.union1d(np.union1d(dirty_prev, changed), touched)
+                encoded = self._encoded[l][:self.node_num]
+                index = torch.from_numpy(dirty)
+                aggregated = torch.sparse.mm(adjacencyMatrix(graph, layer.gcn, dirty), feats)
+                encoded[index] = layer.combine(feats[index], aggregated).t()
+                feats = encoded
+                dirty_prev = dirty
+        return dirty
@@ -0,0 +1,143 @@
+import numpy as np
+
+from graph import CSRGraph
+
+def blockRows(col_num, mem_budget=1<<30, itemsize=8):
+    '''
+    number of query rows processed at once so that the similarity block stays within mem_budget bytes.
+    each row costs the similarity itself, its negated copy and the int64 argpartition indices.
+    '''
+    row_bytes = col_num * (2 * itemsize + 8)
+    return max(1, int(mem_budget // row_bytes))
+
+def topK(similarity, k):
+    '''
+    indices and values of the k largest entries of each row, sorted in descending order.
+    '''
+    k = min(k, similarity.shape[1])
+    rows = np.arange(similarity.shape[0])[:, None]
+    if k < similarity.shape[1]:
+        part_id = np.argpartition(-similarity, k-1, axis=1)[:, :k]
+    else:
+        part_id = np.tile(np.arange(k), (similarity.shape[0], 1))
+    part_sim = similarity[rows, part_id]
+    order = np.argsort(-part_sim, axis=1)
+    return part_id[rows, order], part_sim[rows, order]
+
+def knnSearch(query, database, k, mem_budget=1<<30):
+    '''
+    exact k nearest neighbors (inner product) of each query row in database.
+    similarity is computed block by block, peak memory is bounded by mem_budget bytes.
+    '''
+    query_num = query.shape[0]
+    itemsize = np.result_type(query, database).itemsize
+    block = blockRows(database.shape[0], mem_budget, itemsize)
+    k = min(k, database.shape[0])
+    sort_id = np.empty((query_num, k), dtype=np.int64)
+    sort_sim = np.empty((query_num, k), dtype=np.result_type(query, database))
+    for start in range(0, query_num, block):
+        end = min(start + block, query_num)
+        similarity = np.dot(query[start:end], database.T)
+        sort_id[start:end], sort_sim[start:end] = topK(similarity, k)
+    return sort_id, sort_sim
+
+class IVFIndex(object):
+    '''
+    approximate inner product search with an inverted file index.
+    database vectors are clustered by spherical k-means, a query only visits the nprobe closest lists.
+    '''
+
+    def __init__(self, nlist=1024, nprobe=16, niter=10, train_num=100000, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.train_num = train_num
+        self.seed = seed
+        self.centroids = None
+
+    def train(self, database):
+        rng = np.random.RandomState(self.seed)
+        node_num = database.shape[0]
+        nlist = min(self.nlist, node_num)
+        sample = database[rng.choice(node_num, min(self.train_num, node_num), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+        for _ in range(self.niter):
+            assign = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            ## re-seed empty lists from random samples
+            empty = np.where(counts == 0)[0]
+            sums[empty] = sample[rng.choice(sample.shape[0], len(empty), replace=False)]
+            norm = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norm, 1e-12)
+        self.centroids = centroids
+        return self
+
+    def _assign(self, x, centroids, mem_budget=1<<28):
+        return knnSearch(x, centroids, 1, mem_budget)[0][:, 0]
+
+    def add(self, database):
+        '''
+        store database ids grouped by list, list l holds list_ids[list_ptr[l]:list_ptr[l+1]].
+        '''
+        if self.centroids is None:
+            self.train(database)
+        self.database = database
+        assign = self._assign(database, self.centroids)
+        self.list_ids = np.argsort(assign, kind='mergesort')
+        self.list_ptr = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))))
+        return self
+
+    def search(self, query, k, mem_budget=1<<30):
+        query_num = query.shape[0]
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe = knnSearch(query, self.centroids, nprobe, mem_budget)[0]
+        dtype = np.result_type(query, self.database)
+        sort_id = np.full((query_num, k), -1, dtype=np.int64)
+        sort_sim = np.full((query_num, k), -np.inf, dtype=dtype)
+        ## visit each inverted list once, with all the queries probing it
+        probe_query = np.repeat(np.arange(query_num), nprobe)
+        probe_list = probe.ravel()
+        order = np.argsort(probe_list, kind='mergesort')
+        probe_query, probe_list = probe_query[order], probe_list[order]
+        bounds = np.searchsorted(probe_list, np.arange(len(self.centroids) + 1))
+        for l in range(len(self.centroids)):
+            queries = probe_query[bounds[l]:bounds[l+1]]
+            members = self.list_ids[self.list_ptr[l]:self.list_ptr[l+1]]
+            if len(queries) == 0 or len(members) == 0:
+                continue
+            block = blockRows(len(members) + k, mem_budget, dtype.itemsize)
+            for start in range(0, len(queries), block):
+                q = queries[start:start+block]
+                similarity = np.dot(query[q], self.database[members].T)
+                cand_id = np.concatenate((sort_id[q], np.tile(members, (len(q), 1))), axis=1)
+                cand_sim = np.concatenate((sort_sim[q], similarity), axis=1)
+                top_id, top_sim = topK(cand_sim, k)
+                rows = np.arange(len(q))[:, None]
+                sort_id[q], sort_sim[q] = cand_id[rows, top_id], top_sim
+        return sort_id, sort_sim
+
+def knnGraph(sort_id, sort_sim):
+    '''
+    build CSRGraph from ranked neighbors whose first column is the node itself.
+    edge weights are similarities normalized over the node and its neighbors.
+    '''
+    weight = sort_sim / np.sum(sort_sim, axis=1, keepdims=True)
+    return CSRGraph.fromKnn(sort_id[:, 1:], weight[:, 1:])
+
+def buildKnnGraph(feature_map, knn=10, mem_budget=1<<30, backend='exact', nlist=1024, nprobe=16):
+    '''
+    kNN graph over the rows of feature_map.
+    backend='exact': blocked brute force search, backend='ivf': approximate search with IVFIndex.
+    '''
+    if backend == 'exact':
+        sort_id, sort_sim = knnSearch(feature_map, feature_map, knn+1, mem_budget)
+    elif backend == 'ivf':
+        index = IVFIndex(nlist=nlist, nprobe=nprobe).add(feature_map)
+        sort_id, sort_sim = index.search(feature_map, knn+1, mem_budget)
+        ## lists may hold fewer than knn+1 candidates
+        sort_sim[sort_id < 0] = 0
+    else:
+        raise ValueError("unknown knn backend: {}".format(backend))
+    return knnGraph(sort_id, sort_sim)
@@ -0,0 +1,97 @@
+import torch
+
+import numpy as np
+import math
+import threading
+from Queue import Queue
+
+from sampler import batchRNG
+
+def pinTensors(sample):
+    '''
+    pin the tensors in a (nested) tuple/list of tensors and Blocks.
+    '''
+    if isinstance(sample, torch.Tensor):
+        return sample.pin_memory()
+    if isinstance(sample, (tuple, list)):
+        return type(sample)(pinTensors(s) for s in sample)
+    if hasattr(sample, '__dict__'):
+        for key, value in vars(sample).items():
+            if isinstance(value, torch.Tensor):
+                setattr(sample, key, value.pin_memory())
+    return sample
+
+class GraphLoader(object):
+    '''
+    minibatches of training nodes prepared ahead of time by worker threads.
+    a batch is (batch_nodes, batch_label LongTensor, sample), sample being the sampled neighbors
+    returned by prepare(batch_nodes, rng), e.g., Encoder.prepare or MultiLayerEncoder.prepare.
+    the node order of epoch e and the generator of batch b are batchRNG(seed, e) and batchRNG(seed, e, b),
+    so batches are the same whatever the number of workers.
+    '''
+
+    def __init__(self, nodes, label, batch_size, prepare, seed=0, num_workers=2, queue_size=4, pin_memory=False):
+        '''
+        num_workers: number of threads preparing batches, batches are prepared in the main thread if 0.
+        queue_size: number of prepared batches each worker may hold.
+        '''
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.label = label
+        self.batch_size = batch_size
+        self.prepare = prepare
+        self.seed = seed
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return int(math.ceil(len(self.nodes) / float(self.batch_size)))
+
+    def makeBatch(self, order, epoch, batch):
+        batch_nodes = list(order[batch*self.batch_size: (batch+1)*self.batch_size])
+        batch_label = torch.from_numpy(np.asarray(self.label[batch_nodes], dtype=np.int64))
+        sample = self.prepare(batch_nodes, batchRNG(self.seed, epoch, batch))
+        if self.pin_memory:
+            batch_label, sample = batch_label.pin_memory(), pinTensors(sample)
+        return batch_nodes, batch_label, sample
+
+    def epoch(self, epoch):
+        '''
+        iterate over the batches of an epoch.
+        '''
+        order = self.nodes[batchRNG(self.seed, epoch).permutation(len(self.nodes))]
+        if self.num_workers == 0:
+            for batch in range(len(self)):
+                yield self.makeBatch(order, epoch, batch)
+            return
+
+        ## worker w prepares batches w, w + num_workers, ... in order into its own bounded queue
+        queues = [Queue(self.queue_size) for _ in range(self.num_workers)]
+        stop = threading.Event()
+
+        def work(w):
+            for batch in range(w, len(self), self.num_workers):
+                if stop.is_set():
+                    return
+                try:
+                    queues[w].put((True, self.makeBatch(order, epoch, batch)))
+                except Exception as error:
+                    queues[w].put((False, error))
+                    return
+
+        workers = [threading.Thread(target=work, args=(w,)) for w in range(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for batch in range(len(self)):
+                ok, item = queues[batch % self.num_workers].get()
+                if not ok:
+                    raise item
+                yield item
+        finally:
+            ## unblock workers when the consumer stops early
+            stop.set()
+            for queue in queues:
+                while not queue.empty():
+                    queue.get()
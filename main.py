@@ -1,9 +1,13 @@
 from PACK import *
 from torch.optim.lr_scheduler import StepLR
 
-from encoder import Encoder
+from feature_store import makeEmbedding
+from encoder import Encoder, MultiLayerEncoder
+from propagate import FullGraphPropagation
+from loader import GraphLoader
 from model import SupervisedGraphSAGE
-from utils import buildTestData
+from writer import EmbeddingWriter
+from utils import buildTestData, LazyRegistry
 from collect_graph import removeIsolated, collectGraph_train, collectGraph_train_v2, collectGraph_test
 
 import numpy as np
@@ -18,6 +22,7 @@ import ast
 
 eval_func = '/path/to/compute_ap'
 retrieval_result = '/path/to/retrieval'
+gt_cache = 'gt_cache'
 test_dataset = {
     'oxf': {
         'node_num': 5063,
@@ -32,40 +37,51 @@ test_dataset = {
         'gt_path': '/path/to/paris6k_groundTruth',
     }
 }
-building_oxf = buildTestData(img_path=test_dataset['oxf']['img_testpath'], gt_path=test_dataset['oxf']['gt_path'], eval_func=eval_func)
-building_par = buildTestData(img_path=test_dataset['par']['img_testpath'], gt_path=test_dataset['par']['gt_path'], eval_func=eval_func)
-building = {
-    'oxf': building_oxf,
-    'par': building_par,
-}
-
-def makeModel(node_num, class_num, feature_map, adj_lists, args):
+## evaluators are built on first access
+building = LazyRegistry([
+    (key, lambda key=key: buildTestData(img_path=test_dataset[key]['img_testpath'], gt_path=test_dataset[key]['gt_path'], eval_func=eval_func, cache_dir=gt_cache))
+    for key in ['oxf', 'par']
+])
+
+def makeModel(node_num, class_num, feature_map, adj_lists, args, layer_num=None):
+    '''
+    layer_num: number of encoder layers, args.layer_num if None.
+    '''
+    layer_num = args.layer_num if layer_num is None else layer_num
     ## feature embedding
-    embedding = nn.Embedding(node_num, args.feat_dim)
-    embedding.weight = nn.Parameter(torch.from_numpy(feature_map).float(), requires_grad=False)
+    embedding = makeEmbedding(feature_map, args.feature_store)
 
-    ## two-layer encoder
-    encoder_1 = Encoder(embedding, args.feat_dim, args.embed_dim_1, adj_lists, num_sample=args.num_sample, gcn=args.use_gcn, use_cuda=args.use_cuda)
-    ##
-    ## lambda doesn't support gradient backward !!!
-    ##
-    encoder_2 = Encoder(lambda nodes: encoder_1(nodes).t(), args.embed_dim_1, args.embed_dim_2, adj_lists, num_sample=args.num_sample, gcn=args.use_gcn, use_cuda=args.use_cuda)
+    ## multi-layer encoder, the sampled frontier of all layers is computed once per batch
+    dims = [args.feat_dim, args.embed_dim_1] + [args.embed_dim_2] * (layer_num - 1)
+    encoders = [Encoder(embedding if l == 0 else None, dims[l], dims[l+1], adj_lists, num_sample=args.num_sample, gcn=args.use_gcn, use_cuda=args.use_cuda) for l in range(layer_num)]
+    encoder = MultiLayerEncoder(embedding, encoders, use_cuda=args.use_cuda)
 
     ## model
-    graphsage = SupervisedGraphSAGE(class_num, encoder_1, encoder_2)
+    graphsage = SupervisedGraphSAGE(class_num, encoder)
     if args.use_cuda:
         embedding.cuda()
-        encoder_1.cuda()
-        encoder_2.cuda()
+        encoder.cuda()
         graphsage.cuda()
 
     return graphsage
 
+def loadCheckpoint(checkpoint_path):
+    '''
+    graph_state_dict and number of encoder layers of a checkpoint.
+    checkpoints saved before MultiLayerEncoder have two layers, encoder_1 and encoder, renamed to encoder.layers.N.
+    '''
+    checkpoint = torch.load(checkpoint_path)
+    state_dict = dict(checkpoint['graph_state_dict'])
+    if 'encoder_1.weight' in state_dict:
+        state_dict['encoder.layers.0.weight'] = state_dict.pop('encoder_1.weight')
+        state_dict['encoder.layers.1.weight'] = state_dict.pop('encoder.weight')
+    return state_dict, checkpoint.get('layer_num', 2)
+
 def train(args):
     ## load training data
     print "loading training data ......"
     node_num, class_num = 33792, 569
-    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix)
+    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix, mmap=args.feature_store == 'mmap')
 
     graphsage = makeModel(node_num, class_num, feature_map, adj_lists, args)
 
@@ -83,7 +99,7 @@ def train(args):
 
     epoch_num = args.epoch_num
     batch_size = args.batch_size
-    iter_num = int(math.ceil(args.train_num / float(batch_size)))
+    loader = GraphLoader(train_nodes, label, batch_size, graphsage.encoder.prepare, seed=2, num_workers=args.num_workers, pin_memory=args.use_cuda)
     check_loss = []
     val_accuracy = []
     check_step = args.check_step
@@ -93,15 +109,12 @@ def train(args):
         graphsage.train()
         scheduler.step()
 
-        random.shuffle(train_nodes)
-        for batch in range(iter_num):
-            batch_nodes = train_nodes[batch*batch_size: (batch+1)*batch_size]
-            positive_nodes = [random.choice(list(adj_lists[n])) for n in batch_nodes]
-            batch_label = Variable(torch.LongTensor(label[batch_nodes]))
+        ## batches (sampled neighbors included) are prepared ahead by the loader
+        for batch_nodes, batch_label, sample in loader.epoch(e):
             if args.use_cuda:
-                batch_label = batch_label.cuda()
+                batch_label = batch_label.cuda(non_blocking=True)
             optimizer.zero_grad()
-            loss = graphsage.loss(batch_nodes, batch_label)
+            loss = graphsage.loss(batch_nodes, batch_label, sample)
             loss.backward()
             optimizer.step()
             iter_cnt += 1
@@ -133,6 +146,7 @@ def train(args):
             'learning_rate': args.learning_rate,
             'embed_dim_1': args.embed_dim_1,
             'embed_dim_2': args.embed_dim_2,
+            'layer_num': args.layer_num,
             'num_sample': args.num_sample,
             'use_gcn': args.use_gcn,
             'graph_state_dict': graphsage.state_dict(),
@@ -163,36 +177,47 @@ def train(args):
     return checkpoint_path, class_num
 
 def test(checkpoint_path, class_num, args):
+    save_path = retrieval_result if args.write_rank else None
     for key in building.keys():
         node_num = test_dataset[key]['node_num']
-        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix)
+        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix, mmap=args.feature_store == 'mmap')
 
-        graphsage = makeModel(node_num, class_num, old_feature_map, adj_lists, args)
+        checkpoint_state_dict, layer_num = loadCheckpoint(checkpoint_path)
+        graphsage = makeModel(node_num, class_num, old_feature_map, adj_lists, args, layer_num)
 
-        checkpoint = torch.load(checkpoint_path)
         graphsage_state_dict = graphsage.state_dict()
-        for w in ['weight', 'encoder_1.weight', 'encoder.weight']:
-            graphsage_state_dict.update({w: checkpoint['graph_state_dict'][w]})
+        for w in graphsage_state_dict.keys():
+            ## node features (of any feature store) come from the test graph
+            if 'embedding' in w.split('.'):
+                continue
+            if w not in checkpoint_state_dict:
+                raise KeyError("{} not found in checkpoint {}, keys: {}".format(w, checkpoint_path, sorted(checkpoint_state_dict.keys())))
+            graphsage_state_dict.update({w: checkpoint_state_dict[w]})
         graphsage.load_state_dict(graphsage_state_dict)
         graphsage.eval()
 
-        batch_num = int(math.ceil(node_num/float(args.batch_size)))
-        new_feature_map = torch.FloatTensor()
-        for batch in tqdm(range(batch_num)):
-            start_node = batch*args.batch_size
-            end_node = min((batch+1)*args.batch_size, node_num)
-            test_nodes = range(start_node, end_node)
-            new_feature, _ = graphsage(test_nodes)
-            new_feature = F.normalize(new_feature, p=2, dim=0)
-            new_feature_map = torch.cat((new_feature_map, new_feature.t().cpu().data), dim=0)
-        new_feature_map = new_feature_map.numpy()
-        old_similarity = np.dot(old_feature_map, old_feature_map.T)
-        new_similarity = np.dot(new_feature_map, new_feature_map.T)
-        mAP_old = building[key].evalRetrieval(old_similarity, retrieval_result)
-        mAP_new = building[key].evalRetrieval(new_similarity, retrieval_result)
+        writer = EmbeddingWriter(node_num, graphsage.encoder.embed_dim)
+        if args.full_graph:
+            writer.write(FullGraphPropagation(graphsage.encoder, args.use_cuda).encode().t())
+        else:
+            batch_num = int(math.ceil(node_num/float(args.batch_size)))
+            for batch in tqdm(range(batch_num)):
+                start_node = batch*args.batch_size
+                end_node = min((batch+1)*args.batch_size, node_num)
+                test_nodes = range(start_node, end_node)
+                new_feature, _ = graphsage(test_nodes)
+                new_feature = F.normalize(new_feature, p=2, dim=0)
+                writer.write(new_feature.t())
+        new_feature_map = writer.finish()
+        mAP_old = building[key].evalFeature(old_feature_map, save_path)
+        mAP_new = building[key].evalFeature(new_feature_map, save_path)
         print time.strftime('%Y-%m-%d %H:%M:%S'), 'eval {}'.format(key)
         print 'base feature: {}, new feature: {}'.format(old_feature_map.shape, new_feature_map.shape)
         print 'base mAP: {:.4f}, new mAP: {:.4f}, improvement: {:.4f}'.format(mAP_old, mAP_new, mAP_new-mAP_old)
+        metrics = building[key].evalMetrics(new_feature_map, ks=(10,))
+        print 'new P@10: {:.4f}, new mAP@10: {:.4f}'.format(metrics['P@10'], metrics['mAP@10'])
+        if args.feature_store == 'mmap':
+            print 'feature store cache: {}'.format(graphsage.encoder.embedding.stats())
         print ""
 
 if __name__ == "__main__":
@@ -209,7 +234,12 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--feat_dim', type=int, default=512, required=False, help='input feature dim of node.')
     parser.add_argument('-d', '--embed_dim_1', type=int, default=512, required=False, help='embedded feature dim of encoder_1.')
     parser.add_argument('-D', '--embed_dim_2', type=int, default=512, required=False, help='embedded feature dim of encoder_2.')
+    parser.add_argument('-l', '--layer_num', type=int, default=2, required=False, help='number of encoder layers, layers after the first one have dim embed_dim_2.')
     parser.add_argument('-T', '--train_num', type=int, default=25000, required=False, help='number of training nodes (less than 36460). Left for validation.')
+    parser.add_argument('-w', '--num_workers', type=int, default=2, required=False, help='number of threads preparing training batches, 0 to prepare them in the main thread.')
+    parser.add_argument('-q', '--feature_store', type=str, default='float32', required=False, help='storage of the frozen node features, \'float32\', \'float16\', \'int8\', \'pq\' or \'mmap\' (read from disk on demand).')
+    parser.add_argument('-I', '--full_graph', type=ast.literal_eval, default=True, required=False, help='whether to encode the whole test graph at once without sampling (True) or by minibatches (False).')
+    parser.add_argument('-W', '--write_rank', type=ast.literal_eval, default=False, required=False, help='whether to write rank lists (.rnkl) of queries (True) or not (False).')
     args, _ = parser.parse_known_args()
     print "< < < < < < < < < < < Supervised GraphSAGE > > > > > > > > > >"
     print "= = = = = = = = = = = PARAMETERS SETTING = = = = = = = = = = ="
@@ -1,9 +1,14 @@
 from PACK import *
 from torch.optim.lr_scheduler import StepLR
 
+from feature_store import makeEmbedding
 from encoder import Encoder
+from propagate import FullGraphPropagation
+from aggregate_cache import AggregationCache
+from loader import GraphLoader
 from model import SupervisedGraphSAGE_Single
-from utils import buildTestData
+from writer import EmbeddingWriter
+from utils import buildTestData, LazyRegistry
 from collect_graph import removeIsolated, collectGraph_train, collectGraph_train_v2, collectGraph_test
 
 import numpy as np
@@ -20,6 +25,7 @@ import ast
 
 eval_func = '/path/to/compute_ap'
 retrieval_result = '/path/to/retrieval'
+gt_cache = 'gt_cache'
 test_dataset = {
     'oxf': {
         'node_num': 5063,
@@ -34,17 +40,15 @@ test_dataset = {
         'gt_path': '/path/to/paris6k_groundTruth',
     }
 }
-building_oxf = buildTestData(img_path=test_dataset['oxf']['img_testpath'], gt_path=test_dataset['oxf']['gt_path'], eval_func=eval_func)
-building_par = buildTestData(img_path=test_dataset['par']['img_testpath'], gt_path=test_dataset['par']['gt_path'], eval_func=eval_func)
-building = {
-    'oxf': building_oxf,
-    'par': building_par,
-}
+## evaluators are built on first access
+building = LazyRegistry([
+    (key, lambda key=key: buildTestData(img_path=test_dataset[key]['img_testpath'], gt_path=test_dataset[key]['gt_path'], eval_func=eval_func, cache_dir=gt_cache))
+    for key in ['oxf', 'par']
+])
 
 def makeModel(node_num, class_num, feature_map, adj_lists, args):
     ## feature embedding
-    embedding = nn.Embedding(node_num, args.feat_dim)
-    embedding.weight = nn.Parameter(torch.from_numpy(feature_map).float(), requires_grad=False)
+    embedding = makeEmbedding(feature_map, args.feature_store)
 
     ## single-layer encoder
     encoder = Encoder(embedding, args.feat_dim, args.embed_dim, adj_lists, num_sample=args.num_sample, gcn=args.use_gcn, use_cuda=args.use_cuda)
@@ -62,9 +66,11 @@ def train(checkpoint_path, round, args):
     ## load training data
     print "loading training data ......"
     node_num, class_num = 33792, 569
-    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix, round)
+    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix, round, mmap=args.feature_store == 'mmap')
 
     graphsage = makeModel(node_num, class_num, feature_map, adj_lists, args)
+    if args.cache_variant > 0:
+        graphsage.encoder.cache = AggregationCache(graphsage.encoder, args.cache_dir, round, args.cache_variant, args.cache_dtype)
 
     # if checkpoint_path is not None:
     #     checkpoint = torch.load(checkpoint_path)
@@ -87,7 +93,7 @@ def train(checkpoint_path, round, args):
 	
     epoch_num = args.epoch_num
     batch_size = args.batch_size
-    iter_num = int(math.ceil(args.train_num / float(batch_size)))
+    loader = GraphLoader(train_nodes, label, batch_size, graphsage.encoder.prepare, seed=2, num_workers=args.num_workers, pin_memory=args.use_cuda)
     check_loss = []
     val_accuracy = []
     check_step = args.check_step
@@ -96,15 +102,15 @@ def train(checkpoint_path, round, args):
     for e in range(epoch_num):
         graphsage.train()
         scheduler.step()
+        if graphsage.encoder.cache is not None:
+            graphsage.encoder.cache.setEpoch(e)
 
-        random.shuffle(train_nodes)
-        for batch in range(iter_num):
-            batch_nodes = train_nodes[batch*batch_size: (batch+1)*batch_size]
-            batch_label = torch.LongTensor(label[batch_nodes])
+        ## batches (sampled neighbors included) are prepared ahead by the loader
+        for batch_nodes, batch_label, sample in loader.epoch(e):
             if args.use_cuda:
-                batch_label = batch_label.cuda()
+                batch_label = batch_label.cuda(non_blocking=True)
             optimizer.zero_grad()
-            loss = graphsage.loss(batch_nodes, batch_label)
+            loss = graphsage.loss(batch_nodes, batch_label, sample)
             loss.backward()
             optimizer.step()
             iter_cnt += 1
@@ -130,17 +136,21 @@ def train(checkpoint_path, round, args):
 
     ## extract new feature
     graphsage.eval()
-    new_feature_map = torch.FloatTensor()
-    batch_num = int(math.ceil(node_num/float(batch_size)))
-    for batch in tqdm(range(batch_num)):
-        start_node = batch*args.batch_size
-        end_node = min((batch+1)*args.batch_size, node_num)
-        test_nodes = range(start_node, end_node)
-        new_feature, _ = graphsage(test_nodes)
-        new_feature = F.normalize(new_feature, p=2, dim=0)
-        new_feature_map = torch.cat((new_feature_map, new_feature.t().cpu().data), dim=0)
-    new_feature_map = new_feature_map.numpy()
-    np.save('train_feature_map/feature_map_{}.npy'.format(round+1), new_feature_map)
+    graphsage.encoder.cache = None
+    ## written straight into the feature map of the next round
+    writer = EmbeddingWriter(node_num, graphsage.encoder.embed_dim, 'train_feature_map/feature_map_{}.npy'.format(round+1), args.save_dtype)
+    if args.full_graph:
+        writer.write(FullGraphPropagation(graphsage.encoder, args.use_cuda).encode().t())
+    else:
+        batch_num = int(math.ceil(node_num/float(batch_size)))
+        for batch in tqdm(range(batch_num)):
+            start_node = batch*args.batch_size
+            end_node = min((batch+1)*args.batch_size, node_num)
+            test_nodes = range(start_node, end_node)
+            new_feature, _ = graphsage(test_nodes)
+            new_feature = F.normalize(new_feature, p=2, dim=0)
+            writer.write(new_feature.t())
+    writer.finish()
 
     checkpoint_path = 'checkpoint/checkpoint_single_{}.pth'.format(time.strftime('%Y%m%d%H%M'))
     torch.save({
@@ -178,9 +188,10 @@ def train(checkpoint_path, round, args):
     return checkpoint_path, class_num
 
 def test(checkpoint_path, class_num, round, args):
+    save_path = retrieval_result if args.write_rank else None
     for key in building.keys():
         node_num = test_dataset[key]['node_num']
-        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix, round)
+        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix, round, mmap=args.feature_store == 'mmap')
 
         graphsage = makeModel(node_num, class_num, old_feature_map, adj_lists, args)
 
@@ -191,37 +202,43 @@ def test(checkpoint_path, class_num, round, args):
         graphsage.eval()
 
         batch_num = int(math.ceil(node_num/float(args.batch_size)))
-        new_feature_map = torch.FloatTensor()
-        for batch in tqdm(range(batch_num)):
-            start_node = batch*args.batch_size
-            end_node = min((batch+1)*args.batch_size, node_num)
-            test_nodes = range(start_node, end_node)
-            new_feature, _ = graphsage(test_nodes)
-            new_feature_map = torch.cat((new_feature_map, new_feature.t().cpu().data), dim=0)
-        new_feature_map = new_feature_map.numpy()
-        np.save(os.path.join(test_dataset[key]['feature_path'], 'feature_map_{}.npy'.format(round+1)), new_feature_map)
-
-        old_similarity = np.dot(old_feature_map, old_feature_map.T)
-        new_similarity = np.dot(new_feature_map, new_feature_map.T)
-        mAP_old = building[key].evalRetrieval(old_similarity, retrieval_result)
-        mAP_new = building[key].evalRetrieval(new_similarity, retrieval_result)
+        writer = EmbeddingWriter(node_num, graphsage.encoder.embed_dim, os.path.join(test_dataset[key]['feature_path'], 'feature_map_{}.npy'.format(round+1)), args.save_dtype)
+        if args.full_graph:
+            propagation = FullGraphPropagation(graphsage.encoder, args.use_cuda)
+            writer.write(propagation.encode().t())
+        else:
+            for batch in tqdm(range(batch_num)):
+                start_node = batch*args.batch_size
+                end_node = min((batch+1)*args.batch_size, node_num)
+                test_nodes = range(start_node, end_node)
+                new_feature, _ = graphsage(test_nodes)
+                writer.write(new_feature.t())
+        new_feature_map = np.asarray(writer.finish(), dtype=np.float32)
+
+        mAP_old = building[key].evalFeature(old_feature_map, save_path)
+        mAP_new = building[key].evalFeature(new_feature_map, save_path)
         print time.strftime('%Y-%m-%d %H:%M:%S'), 'eval {}'.format(key)
         print 'base feature: {}, new feature: {}'.format(old_feature_map.shape, new_feature_map.shape)
         print 'base mAP: {:.4f}, new mAP: {:.4f}, improve: {:.4f}'.format(mAP_old, mAP_new, mAP_new-mAP_old)
+        metrics = building[key].evalMetrics(new_feature_map, ks=(10,))
+        print 'new P@10: {:.4f}, new mAP@10: {:.4f}'.format(metrics['P@10'], metrics['mAP@10'])
+        if args.feature_store == 'mmap':
+            print 'feature store cache: {}'.format(graphsage.encoder.embedding.stats())
 
-        meanAggregator = graphsage.encoder.aggregator
         ## directly update node's features by mean pooling features of its neighbors.
-        mean_feature_map = torch.FloatTensor()
-        for batch in tqdm(range(batch_num)):
-            start_node = batch*args.batch_size
-            end_node = min((batch+1)*args.batch_size, node_num)
-            test_nodes = range(start_node, end_node)
-            mean_feature = meanAggregator(test_nodes, [adj_lists[i] for i in test_nodes], args.num_sample)
-            mean_feature = F.normalize(mean_feature, p=2, dim=1)
-            mean_feature_map = torch.cat((mean_feature_map, mean_feature.cpu().data), dim=0)
-        mean_feature_map = mean_feature_map.numpy()
-        mean_similarity = np.dot(mean_feature_map, mean_feature_map.T)
-        mAP_mean = building[key].evalRetrieval(mean_similarity, retrieval_result)
+        writer = EmbeddingWriter(node_num, args.feat_dim)
+        if args.full_graph:
+            ## aggregation of the first layer, computed block by block
+            writer.write(F.normalize(propagation.aggregated, p=2, dim=1))
+        else:
+            for batch in tqdm(range(batch_num)):
+                start_node = batch*args.batch_size
+                end_node = min((batch+1)*args.batch_size, node_num)
+                test_nodes = range(start_node, end_node)
+                mean_feature = graphsage.encoder.aggregate(test_nodes)
+                writer.write(F.normalize(mean_feature, p=2, dim=1))
+        mean_feature_map = writer.finish()
+        mAP_mean = building[key].evalFeature(mean_feature_map, save_path)
         print 'mean aggregation mAP: {:.4f}'.format(mAP_mean)
         print ""
 
@@ -240,6 +257,14 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--embed_dim', type=int, default=512, required=False, help='embedded feature dim of encoder.')
     parser.add_argument('-T', '--train_num', type=int, default=25000, required=False, help='number of training nodes (less than 36460). Left for validation.')
     parser.add_argument('-O', '--round', type=int, default=1, required=False, help='number of updating features and graph')
+    parser.add_argument('-w', '--num_workers', type=int, default=2, required=False, help='number of threads preparing training batches, 0 to prepare them in the main thread.')
+    parser.add_argument('-q', '--feature_store', type=str, default='float32', required=False, help='storage of the frozen node features, \'float32\', \'float16\', \'int8\', \'pq\' or \'mmap\' (read from disk on demand).')
+    parser.add_argument('-I', '--full_graph', type=ast.literal_eval, default=True, required=False, help='whether to encode the whole test graph at once without sampling (True) or by minibatches (False).')
+    parser.add_argument('-K', '--cache_variant', type=int, default=0, required=False, help='number of cached sampled aggregations per node (one exact aggregation if no neighbor is dropped), 0 for no cache.')
+    parser.add_argument('-M', '--cache_dir', type=str, default='aggregate_cache', required=False, help='folder of cached aggregations.')
+    parser.add_argument('-P', '--cache_dtype', type=str, default='float16', required=False, help='storage type of cached aggregations, \'float16\' or \'float32\'.')
+    parser.add_argument('-s', '--save_dtype', type=str, default='float32', required=False, help='storage type of the feature maps of the next round, \'float32\' or \'float16\'.')
+    parser.add_argument('-W', '--write_rank', type=ast.literal_eval, default=False, required=False, help='whether to write rank lists (.rnkl) of queries (True) or not (False).')
     args, _ = parser.parse_known_args()
     print "< < < < < < < < Supervised Single-layer GraphSAGE > > > > > > >"
     print "= = = = = = = = = = = PARAMETERS SETTING = = = = = = = = = = ="
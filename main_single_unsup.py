@@ -1,9 +1,13 @@
 from PACK import *
 from torch.optim.lr_scheduler import StepLR
 
+from feature_store import makeEmbedding
 from encoder import Encoder
-from model import UnsupervisedGraphSAGE_Single
-from utils import buildTestData
+from sampler import PairSampler, batchRNG
+from propagate import FullGraphPropagation
+from model import UnsupervisedGraphSAGE_Single, MemoryBank
+from writer import EmbeddingWriter
+from utils import buildTestData, LazyRegistry
 from collect_graph import removeIsolated, collectGraph_train, collectGraph_train_v2, collectGraph_test
 
 import numpy as np
@@ -21,6 +25,7 @@ import sys
 
 eval_func = '/path/to/compute_ap'
 retrieval_result = '/path/to/retrieval'
+gt_cache = 'gt_cache'
 test_dataset = {
     'oxf': {
         'node_num': 5063,
@@ -35,23 +40,22 @@ test_dataset = {
         'gt_path': '/path/to/paris6k_groundTruth',
     }
 }
-building_oxf = buildTestData(img_path=test_dataset['oxf']['img_testpath'], gt_path=test_dataset['oxf']['gt_path'], eval_func=eval_func)
-building_par = buildTestData(img_path=test_dataset['par']['img_testpath'], gt_path=test_dataset['par']['gt_path'], eval_func=eval_func)
-building = {
-    'oxf': building_oxf,
-    'par': building_par,
-}
+## evaluators are built on first access
+building = LazyRegistry([
+    (key, lambda key=key: buildTestData(img_path=test_dataset[key]['img_testpath'], gt_path=test_dataset[key]['gt_path'], eval_func=eval_func, cache_dir=gt_cache))
+    for key in ['oxf', 'par']
+])
 
 def makeModel(node_num, class_num, feature_map, adj_lists, args):
     ## feature embedding
-    embedding = nn.Embedding(node_num, args.feat_dim)
-    embedding.weight = nn.Parameter(torch.from_numpy(feature_map).float(), requires_grad=False)
+    embedding = makeEmbedding(feature_map, args.feature_store)
 
     ## single-layer encoder
     encoder = Encoder(embedding, args.feat_dim, args.embed_dim, adj_lists, num_sample=args.num_sample, gcn=args.use_gcn, use_cuda=args.use_cuda)
 
     ## model
-    graphsage = UnsupervisedGraphSAGE_Single(class_num, encoder)
+    bank = MemoryBank(args.bank_size, args.embed_dim, args.bank_staleness, args.use_cuda) if args.bank_size > 0 else None
+    graphsage = UnsupervisedGraphSAGE_Single(class_num, encoder, args.mining, args.hard_k, args.loss_type, bank)
     if args.use_cuda:
         embedding.cuda()
         encoder.cuda()
@@ -63,7 +67,7 @@ def train(args):
     ## load training data
     print "loading training data ......"
     node_num, class_num = removeIsolated(args.suffix)
-    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix)
+    label, feature_map, adj_lists = collectGraph_train_v2(node_num, class_num, args.feat_dim, args.num_sample, args.suffix, mmap=args.feature_store == 'mmap')
 
     graphsage = makeModel(node_num, class_num, feature_map, adj_lists, args)
 
@@ -74,7 +78,8 @@ def train(args):
     ## train
     random.seed(2)
     train_nodes = range(args.train_num)
-    positive = [random.choice(filter(lambda node: node != anchor and label[node] == label[anchor], train_nodes)) for anchor in train_nodes]
+    pair_sampler = PairSampler(label, train_nodes)
+    positive = pair_sampler.positives(train_nodes, batchRNG(2, 0))
 
     epoch_num = args.epoch_num
     batch_size = args.batch_size
@@ -90,9 +95,15 @@ def train(args):
         scheduler.step()
 
         random.shuffle(train_nodes)
+        if args.redraw_positive and e > 0:
+            positive = pair_sampler.positives(range(args.train_num), batchRNG(2, e))
         for batch in range(iter_num):
             anchor_nodes = train_nodes[batch*batch_size: (batch+1)*batch_size]
-            positive_nodes = [positive[anchor] for anchor in anchor_nodes]
+            if args.hard_negative > 0:
+                ## hardest negatives (by input features) of some anchors join the batch with their positives
+                negative_nodes = pair_sampler.negatives(anchor_nodes[:args.hard_negative], batchRNG(2, e, batch), feature_map)
+                anchor_nodes = anchor_nodes + list(negative_nodes)
+            positive_nodes = list(positive[anchor_nodes])
             anchor_label = torch.LongTensor(label[anchor_nodes])
             if args.use_cuda:
                 anchor_label = anchor_label.cuda()
@@ -135,9 +146,10 @@ def train(args):
     return checkpoint_path, class_num
 
 def test(checkpoint_path, class_num, args):
+    save_path = retrieval_result if args.write_rank else None
     for key in building.keys():
         node_num = test_dataset[key]['node_num']
-        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix)
+        old_feature_map, adj_lists = collectGraph_test(test_dataset[key]['feature_path'], node_num, args.feat_dim, args.num_sample, args.suffix, mmap=args.feature_store == 'mmap')
 
         graphsage = makeModel(node_num, class_num, old_feature_map, adj_lists, args)
 
@@ -149,35 +161,42 @@ def test(checkpoint_path, class_num, args):
         graphsage.eval()
 
         batch_num = int(math.ceil(node_num/float(args.batch_size)))
-        new_feature_map = torch.FloatTensor()
-        for batch in tqdm(range(batch_num)):
-            start_node = batch*args.batch_size
-            end_node = min((batch+1)*args.batch_size, node_num)
-            test_nodes = range(start_node, end_node)
-            new_feature = graphsage(test_nodes)
-            new_feature_map = torch.cat((new_feature_map, new_feature.t().cpu().data), dim=0)
-        new_feature_map = new_feature_map.numpy()
-        old_similarity = np.dot(old_feature_map, old_feature_map.T)
-        new_similarity = np.dot(new_feature_map, new_feature_map.T)
-        mAP_old = building[key].evalRetrieval(old_similarity, retrieval_result)
-        mAP_new = building[key].evalRetrieval(new_similarity, retrieval_result)
+        writer = EmbeddingWriter(node_num, graphsage.encoder.embed_dim)
+        if args.full_graph:
+            propagation = FullGraphPropagation(graphsage.encoder, args.use_cuda)
+            writer.write(propagation.encode().t())
+        else:
+            for batch in tqdm(range(batch_num)):
+                start_node = batch*args.batch_size
+                end_node = min((batch+1)*args.batch_size, node_num)
+                test_nodes = range(start_node, end_node)
+                new_feature = graphsage(test_nodes)
+                writer.write(new_feature.t())
+        new_feature_map = writer.finish()
+        mAP_old = building[key].evalFeature(old_feature_map, save_path)
+        mAP_new = building[key].evalFeature(new_feature_map, save_path)
         print time.strftime('%Y-%m-%d %H:%M:%S'), 'eval {}'.format(key)
         print 'base feature: {}, new feature: {}'.format(old_feature_map.shape, new_feature_map.shape)
         print 'base mAP: {:.4f}, new mAP: {:.4f}, improve: {:.4f}'.format(mAP_old, mAP_new, mAP_new-mAP_old)
+        metrics = building[key].evalMetrics(new_feature_map, ks=(10,))
+        print 'new P@10: {:.4f}, new mAP@10: {:.4f}'.format(metrics['P@10'], metrics['mAP@10'])
+        if args.feature_store == 'mmap':
+            print 'feature store cache: {}'.format(graphsage.encoder.embedding.stats())
 
-        meanAggregator = graphsage.encoder.aggregator
         ## directly update node's features by mean pooling features of its neighbors.
-        mean_feature_map = torch.FloatTensor()
-        for batch in tqdm(range(batch_num)):
-            start_node = batch*args.batch_size
-            end_node = min((batch+1)*args.batch_size, node_num)
-            test_nodes = range(start_node, end_node)
-            mean_feature = meanAggregator(test_nodes, [adj_lists[i] for i in test_nodes], args.num_sample)
-            mean_feature = F.normalize(mean_feature, p=2, dim=1)
-            mean_feature_map = torch.cat((mean_feature_map, mean_feature.cpu().data), dim=0)
-        mean_feature_map = mean_feature_map.numpy()
-        mean_similarity = np.dot(mean_feature_map, mean_feature_map.T)
-        mAP_mean = building[key].evalRetrieval(mean_similarity, retrieval_result)
+        writer = EmbeddingWriter(node_num, args.feat_dim)
+        if args.full_graph:
+            ## aggregation of the first layer, computed block by block
+            writer.write(F.normalize(propagation.aggregated, p=2, dim=1))
+        else:
+            for batch in tqdm(range(batch_num)):
+                start_node = batch*args.batch_size
+                end_node = min((batch+1)*args.batch_size, node_num)
+                test_nodes = range(start_node, end_node)
+                mean_feature = graphsage.encoder.aggregate(test_nodes)
+                writer.write(F.normalize(mean_feature, p=2, dim=1))
+        mean_feature_map = writer.finish()
+        mAP_mean = building[key].evalFeature(mean_feature_map, save_path)
         print 'mean aggregation mAP: {:.4f}'.format(mAP_mean)
         print ""
 
@@ -195,6 +214,16 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--feat_dim', type=int, default=512, required=False, help='input feature dim of node.')
     parser.add_argument('-d', '--embed_dim', type=int, default=512, required=False, help='embedded feature dim of encoder.')
     parser.add_argument('-T', '--train_num', type=int, default=33792, required=False, help='number of training nodes (less than 36460). Left for validation.')
+    parser.add_argument('-P', '--redraw_positive', type=ast.literal_eval, default=False, required=False, help='whether to re-draw positives every epoch (True) or draw them once (False).')
+    parser.add_argument('-H', '--hard_negative', type=int, default=0, required=False, help='number of hard negatives (with their positives) added to each batch.')
+    parser.add_argument('-m', '--mining', type=str, default='all', required=False, help='negative mining of the triplet loss, \'all\', \'semihard\' or \'hardest\'.')
+    parser.add_argument('-k', '--hard_k', type=int, default=10, required=False, help='number of hardest negatives per anchor if mining is \'hardest\'.')
+    parser.add_argument('-l', '--loss_type', type=str, default='triplet', required=False, help='metric loss, \'triplet\' or \'npair\'.')
+    parser.add_argument('-Q', '--bank_size', type=int, default=0, required=False, help='number of past embeddings kept as extra negatives, 0 for no memory bank.')
+    parser.add_argument('-A', '--bank_staleness', type=int, default=0, required=False, help='memory bank entries older than this number of iterations are not used, 0 for no limit.')
+    parser.add_argument('-q', '--feature_store', type=str, default='float32', required=False, help='storage of the frozen node features, \'float32\', \'float16\', \'int8\', \'pq\' or \'mmap\' (read from disk on demand).')
+    parser.add_argument('-I', '--full_graph', type=ast.literal_eval, default=True, required=False, help='whether to encode the whole test graph at once without sampling (True) or by minibatches (False).')
+    parser.add_argument('-W', '--write_rank', type=ast.literal_eval, default=False, required=False, help='whether to write rank lists (.rnkl) of queries (True) or not (False).')
     args, _ = parser.parse_known_args()
     print "< < < < < < < Unsupervised Single-layer GraphSAGE > > > > > > >"
     print "= = = = = = = = = = = PARAMETERS SETTING = = = = = = = = = = ="
@@ -2,23 +2,28 @@ from PACK import *
 
 ## supervised graphsage, classification loss
 class SupervisedGraphSAGE(nn.Module):
-    def __init__(self, class_num, encoder_1, encoder_2):
+    def __init__(self, class_num, encoder):
+        '''
+        encoder: MultiLayerEncoder
+        '''
         super(SupervisedGraphSAGE, self).__init__()
         self.class_num = class_num
-        self.encoder_1 = encoder_1
-        self.encoder = encoder_2
+        self.encoder = encoder
         self.criterion = nn.CrossEntropyLoss()
 
         self.weight = nn.Parameter(torch.FloatTensor(class_num, self.encoder.embed_dim))
         init.xavier_uniform_(self.weight)
 
-    def forward(self, nodes):
-        new_feature = self.encoder(nodes)
+    def forward(self, nodes, sample=None):
+        '''
+        sample: sampled neighbors of nodes given by encoder.prepare, if any.
+        '''
+        new_feature = self.encoder(nodes, sample=sample)
         scores = self.weight.mm(new_feature)
         return new_feature, scores.t()
 
-    def loss(self, nodes, labels):
-        _, scores = self.forward(nodes)
+    def loss(self, nodes, labels, sample=None):
+        _, scores = self.forward(nodes, sample)
         return self.criterion(scores, labels.squeeze())
 
 class SupervisedGraphSAGE_Single(nn.Module):
@@ -32,24 +37,137 @@ class SupervisedGraphSAGE_Single(nn.Module):
                 nn.Linear(encoder.embed_dim, class_num, bias=True)
         )
 
-    def forward(self, nodes):
-        new_feature = self.encoder(nodes)
+    def forward(self, nodes, sample=None):
+        new_feature = self.encoder(nodes, sample=sample)
         hidden_activation = F.relu(new_feature)
         scores = self.fc(hidden_activation.t())
         return new_feature, scores
 
-    def loss(self, nodes, labels):
-        _, scores = self.forward(nodes)
+    def loss(self, nodes, labels, sample=None):
+        _, scores = self.forward(nodes, sample)
         return self.criterion(scores, labels.squeeze())
 
 
-## unsupervised graphsage, n-pair loss
+## FIFO memory bank of past embeddings, extra negatives for metric learning
+class MemoryBank(object):
+    def __init__(self, size, feature_dim, staleness=0, use_cuda=False):
+        '''
+        ring buffer of the last size embeddings and their labels.
+        staleness: entries enqueued more than staleness iterations ago are not used, no limit if 0.
+        '''
+        device = torch.device('cuda' if use_cuda else 'cpu')
+        self.size = size
+        self.staleness = staleness
+        self.features = torch.zeros(size, feature_dim, device=device)
+        self.labels = torch.full((size,), -1, dtype=torch.long, device=device)
+        self.steps = torch.zeros(size, dtype=torch.long, device=device)
+        self.ptr = 0
+        self.step = 0
+
+    def enqueue(self, feature, label):
+        '''
+        feature: (feature_dim x batch), label: batch labels. the oldest entries are overwritten.
+        '''
+        feature, label = feature.detach().t()[-self.size:], label.view(-1)[-self.size:]
+        index = (self.ptr + torch.arange(feature.size(0), device=feature.device)) % self.size
+        self.features[index] = feature
+        self.labels[index] = label
+        self.steps[index] = self.step
+        self.ptr = (self.ptr + feature.size(0)) % self.size
+        self.step += 1
+
+    def get(self):
+        '''
+        usable entries, (num x feature_dim) features and num labels.
+        '''
+        valid = self.labels >= 0
+        if self.staleness > 0:
+            valid &= (self.step - self.steps) <= self.staleness
+        return self.features[valid], self.labels[valid]
+
+
+## in-batch triplet loss
+class TripletLoss(nn.Module):
+    def __init__(self, margin=0.3, strategy='all', k=10):
+        '''
+        strategy='all': sum of hinge losses over all negatives (of each anchor),
+        strategy='semihard': the closest negative farther than the positive (the farthest negative if there is none),
+        strategy='hardest': sum over the k closest negatives.
+        '''
+        super(TripletLoss, self).__init__()
+        self.margin = margin
+        self.strategy = strategy
+        self.k = k
+
+    def forward(self, anchor_feature, positive_feature, label, bank=None):
+        '''
+        anchor_feature, positive_feature: (feature_dim x batch), l2-normalized columns.
+        positive i is the positive of anchor i, the positives of other labels are the negatives.
+        bank: (features, labels) of MemoryBank.get(), entries of other labels are extra negatives.
+        '''
+        candidate_label = label.view(-1)
+        if bank is not None:
+            positive_feature = torch.cat((positive_feature, bank[0].t()), dim=1)
+            candidate_label = torch.cat((candidate_label, bank[1]))
+        ## (batch x candidates) squared distances, the diagonal holds the positive pairs
+        sqdist = 2 - 2 * torch.matmul(anchor_feature.t(), positive_feature)
+        pos_dist = torch.diagonal(sqdist).view(-1, 1)
+        negative = label.view(-1, 1) != candidate_label.view(1, -1)
+
+        if self.strategy == 'all':
+            return torch.mean(torch.sum(F.relu(pos_dist - sqdist + self.margin) * negative.float(), dim=1))
+        elif self.strategy == 'semihard':
+            inf = sqdist.new_tensor(float('inf'))
+            semihard = torch.where(negative & (sqdist > pos_dist), sqdist, inf).min(dim=1, keepdim=True)[0]
+            hardest = torch.where(negative, sqdist, -inf).max(dim=1, keepdim=True)[0]
+            neg_dist = torch.where(torch.isinf(semihard), hardest, semihard)
+            valid = ~torch.isinf(neg_dist)
+            return torch.sum(F.relu(pos_dist - neg_dist + self.margin)[valid]) / sqdist.size(0)
+        elif self.strategy == 'hardest':
+            k = min(self.k, sqdist.size(1))
+            neg_dist, index = torch.topk(torch.where(negative, sqdist, sqdist.new_tensor(float('inf'))), k, dim=1, largest=False)
+            valid = torch.gather(negative, 1, index).float()
+            return torch.mean(torch.sum(F.relu(pos_dist - neg_dist + self.margin) * valid, dim=1))
+        raise ValueError("unknown mining strategy: {}".format(self.strategy))
+
+
+## in-batch n-pair loss
+class NPairLoss(nn.Module):
+    def forward(self, anchor_feature, positive_feature, label, bank=None):
+        '''
+        softmax over positives (and bank entries) of each anchor, the targets are the candidates of the same label.
+        see TripletLoss for the arguments.
+        '''
+        anchor_feature = F.normalize(anchor_feature, p=2, dim=0)
+        positive_feature = F.normalize(positive_feature, p=2, dim=0)
+        candidate_label = label.view(-1)
+        if bank is not None:
+            positive_feature = torch.cat((positive_feature, bank[0].t()), dim=1)
+            candidate_label = torch.cat((candidate_label, bank[1]))
+        target = (label.view(-1, 1) == candidate_label.view(1, -1)).float()
+
+        target = target / torch.sum(target, dim=1, keepdim=True).float()
+        logit = torch.matmul(anchor_feature.t(), positive_feature)
+
+        return - torch.mean(torch.sum(target * F.log_softmax(logit, dim=1), dim=1))
+
+
+## unsupervised graphsage, triplet or n-pair loss
 class UnsupervisedGraphSAGE_Single(nn.Module):
-    def __init__(self, class_num, encoder):
+    def __init__(self, class_num, encoder, strategy='all', k=10, loss_type='triplet', bank=None):
+        '''
+        strategy, k: negative mining of the triplet loss, see TripletLoss.
+        loss_type: 'triplet' or 'npair'.
+        bank: MemoryBank of past embeddings used as extra negatives, only in-batch negatives if None.
+        '''
         super(UnsupervisedGraphSAGE_Single, self).__init__()
         self.class_num = class_num
         self.encoder = encoder
         self.criterion = nn.CrossEntropyLoss()
+        self.loss_type = loss_type
+        self.bank = bank
+        self.triplet = TripletLoss(0.3, strategy, k)
+        self.npair = NPairLoss()
 
         self.weight = nn.Parameter(torch.FloatTensor(class_num, encoder.embed_dim))
         init.xavier_uniform_(self.weight)
@@ -58,41 +176,29 @@ class UnsupervisedGraphSAGE_Single(nn.Module):
         return self.encoder(nodes)
 
     def loss(self, nodes_anchor, nodes_positive, label):
-
-        ## triplet loss + classification loss
-        anchor_feature = self.forward(nodes_anchor)
-        positive_feature = self.forward(nodes_positive)
-        anchor_activation = F.relu(anchor_feature)
-        positive_activation = F.relu(positive_feature)
-        anchor_score = self.weight.mm(anchor_activation)
-        positive_score = self.weight.mm(positive_activation)
-        target = label.view(label.size(0), -1)
-        target = (target != target.t()).float()
-
-        sqdist = 2 - 2 * torch.matmul(anchor_feature.t(), positive_feature)
-        pos_dist = torch.diagonal(sqdist)
-        diff_dist = pos_dist.view(-1, 1).repeat(1, sqdist.size(0)) - sqdist
-        loss_feature = torch.mean(torch.sum(F.relu(diff_dist + 0.3) * target, dim=1))
-        loss_class = self.criterion(anchor_score.t(), label.squeeze()) + self.criterion(positive_score.t(), label.squeeze())
-
-        return loss_feature + loss_class * 0.5
-
-        ## n-pair loss + classification loss
-
-        # anchor_feature = self.forward(nodes_anchor)
-        # positive_feature = self.forward(nodes_positive)
-        # anchor_score = self.weight.mm(anchor_feature)
-        # positive_score = self.weight.mm(positive_feature)
-        #
-        # anchor_feature = F.normalize(anchor_feature, p=2, dim=0)
-        # positive_feature = F.normalize(positive_feature, p=2, dim=0)
-        # target = label.view(label.size(0), -1)
-        # target = (target == target.t()).float()
-        #
-        # target = target / torch.sum(target, dim=1, keepdim=True).float()
-        # logit = torch.matmul(anchor_feature.t(), positive_feature)
-        #
-        # loss_feature = - torch.mean(torch.sum(target * F.log_softmax(logit, dim=1), dim=1))
-        # loss_class = self.criterion(anchor_score.t(), label.squeeze()) + self.criterion(positive_score.t(), label.squeeze())
-        #
-        # return loss_class + 0.05 * loss_feature
+        ## anchors and positives are encoded by one call
+        batch_size = len(nodes_anchor)
+        feature = self.forward(list(nodes_anchor) + list(nodes_positive))
+        anchor_feature, positive_feature = feature[:, :batch_size], feature[:, batch_size:]
+        bank = self.bank.get() if self.bank is not None else None
+
+        if self.loss_type == 'triplet':
+            ## triplet loss + classification loss
+            score = self.weight.mm(F.relu(feature))
+            anchor_score, positive_score = score[:, :batch_size], score[:, batch_size:]
+            loss_feature = self.triplet(anchor_feature, positive_feature, label, bank)
+            loss_class = self.criterion(anchor_score.t(), label.squeeze()) + self.criterion(positive_score.t(), label.squeeze())
+            loss = loss_feature + loss_class * 0.5
+        elif self.loss_type == 'npair':
+            ## n-pair loss + classification loss
+            score = self.weight.mm(feature)
+            anchor_score, positive_score = score[:, :batch_size], score[:, batch_size:]
+            loss_feature = self.npair(anchor_feature, positive_feature, label, bank)
+            loss_class = self.criterion(anchor_score.t(), label.squeeze()) + self.criterion(positive_score.t(), label.squeeze())
+            loss = loss_class + 0.05 * loss_feature
+        else:
+            raise ValueError("unknown loss type: {}".format(self.loss_type))
+
+        if self.bank is not None:
+            self.bank.enqueue(feature, torch.cat((label.view(-1), label.view(-1))))
+        return loss
@@ -0,0 +1,121 @@
+from PACK import *
+
+import numpy as np
+
+from encoder import MultiLayerEncoder
+from feature_store import lookupRows
+
+def adjacencyRows(adj_lists, gcn=False, nodes=None):
+    '''
+    (rows, cols, weights) of the row-normalized adjacency of CSRGraph adj_lists, see adjacencyMatrix.
+    rows index nodes, cols are node ids.
+    '''
+    node_num = len(adj_lists)
+    if nodes is None:
+        nodes = np.arange(node_num)
+    else:
+        nodes = np.asarray(nodes, dtype=np.int64)
+        adj_lists = adj_lists.batch(nodes)
+    row_num = len(nodes)
+    rows = adj_lists.rows()
+    cols = adj_lists.indices.astype(np.int64)
+    weights = adj_lists.weights
+    if gcn:
+        has_self = np.zeros(row_num, dtype=bool)
+        has_self[rows[cols == nodes[rows]]] = True
+        loop = np.where(~has_self)[0]
+        rows = np.concatenate((rows, loop))
+        cols = np.concatenate((cols, nodes[loop]))
+        weights = np.concatenate((weights, np.ones(len(loop), dtype=np.float32)))
+    row_sum = np.bincount(rows, weights, minlength=row_num)
+    weights = (weights / row_sum[rows]).astype(np.float32)
+    return rows, cols, weights
+
+def adjacencyMatrix(adj_lists, gcn=False, nodes=None):
+    '''
+    row-normalized sparse adjacency (node_num x node_num) of CSRGraph adj_lists,
+    i.e., the mean aggregation of MeanAggregator without sampling. self-loops are added if gcn.
+    nodes: only the rows of nodes, (len(nodes) x node_num), all rows if None.
+    '''
+    rows, cols, weights = adjacencyRows(adj_lists, gcn, nodes)
+    row_num = len(adj_lists) if nodes is None else len(nodes)
+    indices = torch.from_numpy(np.stack((rows, cols)))
+    return torch.sparse_coo_tensor(indices, torch.from_numpy(weights), (row_num, len(adj_lists)))
+
+def aggregateRows(adj_lists, gcn, embedding, nodes):
+    '''
+    rows nodes of A*X, (len(nodes) x feature_dim), where X is the table of embedding (nn.Embedding or a feature store).
+    only the neighbors of nodes are looked up, the table is never read as a whole.
+    '''
+    rows, cols, weights = adjacencyRows(adj_lists, gcn, nodes)
+    unique_cols, cols = np.unique(cols, return_inverse=True)
+    feats = lookupRows(embedding, unique_cols)
+    indices = torch.from_numpy(np.stack((rows, cols.astype(np.int64))))
+    adjacency = torch.sparse_coo_tensor(indices, torch.from_numpy(weights), (len(nodes), len(unique_cols)))
+    return torch.sparse.mm(adjacency.to(feats.device), feats)
+
+class FullGraphPropagation(object):
+    '''
+    inference over the whole graph (SGC style) instead of sampled minibatches.
+    each layer is one sparse matmul A*X plus one GEMM. the first layer runs over blocks of block_size rows,
+    gathering only the input features their neighbors need, so that a feature store (feature_store.py)
+    is never dequantized or read as a whole.
+    outputs match the batched encoder when no neighbor is dropped by sampling.
+    '''
+
+    def __init__(self, encoder, use_cuda=False, block_size=8192):
+        '''
+        encoder: Encoder or MultiLayerEncoder.
+        '''
+        self.layers = list(encoder.layers) if isinstance(encoder, MultiLayerEncoder) else [encoder]
+        self.embedding = encoder.embedding
+        self.use_cuda = use_cuda
+        self.block_size = block_size
+        self.node_num = len(self.layers[0].adj_lists)
+        self._aggregated = None
+        adjacency = {}
+        self.adjacency = []
+        for layer in self.layers[1:]:
+            key = (id(layer.adj_lists), layer.gcn)
+            if key not in adjacency:
+                adjacency[key] = adjacencyMatrix(layer.adj_lists, layer.gcn)
+                if use_cuda:
+                    adjacency[key] = adjacency[key].cuda()
+            self.adjacency.append(adjacency[key])
+
+    def rowBlocks(self):
+        for start in range(0, self.node_num, self.block_size):
+            yield np.arange(start, min(start + self.block_size, self.node_num))
+
+    @property
+    def aggregated(self):
+        '''
+        A*X of the first layer (the mean aggregation baseline), (node_num x feature_dim), computed on first access.
+        '''
+        if self._aggregated is None:
+            first = self.layers[0]
+            with torch.no_grad():
+                aggregated = first.weight.new_empty(self.node_num, first.feature_dim)
+                for nodes in self.rowBlocks():
+                    aggregated[nodes[0]:nodes[-1]+1] = aggregateRows(first.adj_lists, first.gcn, self.embedding, nodes)
+            self._aggregated = aggregated
+        return self._aggregated
+
+    def encode(self):
+        '''
+        return new features of all nodes, (embed_dim x node_num).
+        '''
+        first = self.layers[0]
+        with torch.no_grad():
+            new_feature = first.weight.new_empty(first.embed_dim, self.node_num)
+            for nodes in self.rowBlocks():
+                if self._aggregated is not None:
+                    aggregated = self._aggregated[nodes[0]:nodes[-1]+1]
+                else:
+                    aggregated = aggregateRows(first.adj_lists, first.gcn, self.embedding, nodes)
+                self_feats = None if first.gcn else lookupRows(self.embedding, nodes)
+                new_feature[:, nodes[0]:nodes[-1]+1] = first.combine(self_feats, aggregated)
+            for layer, adjacency in zip(self.layers[1:], self.adjacency):
+                feats = new_feature.t()
+                new_feature = layer.combine(feats, torch.sparse.mm(adjacency, feats))
+        return new_feature
@@ -0,0 +1,168 @@
+from PACK import *
+
+from encoder import Encoder
+from knn import topK, knnSearch, knnGraph
+from propagate import FullGraphPropagation
+
+import numpy as np
+import os
+import sys
+import time
+import json
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import argparse
+import ast
+
+class QueryEngine(object):
+    '''
+    retrieval with unseen query descriptors through a trained single-layer encoder (main_single / main_single_unsup checkpoints).
+    the database graph and its new features are computed once, a query is encoded as a node attached to its kNN
+    among the database nodes (the database graph is not changed), i.e., as main_single.test encodes a database node.
+    queries are answered with numpy only, one or a micro-batch at a time.
+    '''
+
+    def __init__(self, checkpoint_path, feature_map, knn=None, new_feature_map=None, names=None):
+        '''
+        feature_map: (node_num x feat_dim) database features.
+        knn: number of neighbors in the graph, num_sample of the checkpoint (as in main_single.test) if None.
+        new_feature_map: database features already encoded by the checkpoint, computed here if None.
+        names: names of database nodes, ids are returned if None.
+        '''
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        self.knn = checkpoint['num_sample'] if knn is None else knn
+        self.gcn = checkpoint['use_gcn']
+        if 'encoder.weight' not in checkpoint['graph_state_dict']:
+            raise ValueError("{} is not a single-layer checkpoint (main_single / main_single_unsup), multi-layer checkpoints of main are not supported.".format(checkpoint_path))
+        weight = checkpoint['graph_state_dict']['encoder.weight']
+        self.features = np.ascontiguousarray(feature_map, dtype=np.float32)
+        self.names = names
+
+        if new_feature_map is None:
+            sort_id, sort_sim = knnSearch(self.features, self.features, self.knn+1)
+            embedding = nn.Embedding(self.features.shape[0], self.features.shape[1])
+            embedding.weight = nn.Parameter(torch.from_numpy(self.features), requires_grad=False)
+            encoder = Encoder(embedding, self.features.shape[1], weight.size(0), knnGraph(sort_id, sort_sim), num_sample=None, gcn=self.gcn)
+            encoder.weight.data.copy_(weight)
+            new_feature_map = FullGraphPropagation(encoder).encode().t().numpy()
+        self.new_features = np.ascontiguousarray(new_feature_map, dtype=np.float32)
+        ## (feat_dim x embed_dim) blocks of the weight, applied to the query and to the neighbor mean
+        weight = weight.numpy()
+        feat_dim = self.features.shape[1]
+        self.weight_self = None if self.gcn else np.ascontiguousarray(weight[:, :feat_dim].T)
+        self.weight_neigh = np.ascontiguousarray((weight if self.gcn else weight[:, feat_dim:]).T)
+
+    def encode(self, descriptors):
+        '''
+        descriptors: (query_num x feat_dim), return new features (query_num x embed_dim).
+        '''
+        query = np.atleast_2d(np.asarray(descriptors, dtype=np.float32))
+        sort_id, sort_sim = topK(np.dot(query, self.features.T), self.knn)
+        ## edge weights as in knnGraph, normalized over the query and its neighbors
+        self_sim = np.sum(query * query, axis=1, keepdims=True)
+        weight = sort_sim / (self_sim + np.sum(sort_sim, axis=1, keepdims=True))
+        aggregated = np.einsum('qk,qkd->qd', weight, self.features[sort_id])
+        if self.gcn:
+            ## self-loop of weight 1, as MeanAggregator(gcn=True)
+            new_feature = (aggregated + query) / (1 + np.sum(weight, axis=1, keepdims=True))
+            new_feature = np.dot(new_feature, self.weight_neigh)
+        else:
+            aggregated /= np.sum(weight, axis=1, keepdims=True)
+            new_feature = np.dot(query, self.weight_self) + np.dot(aggregated, self.weight_neigh)
+        return new_feature / np.maximum(np.linalg.norm(new_feature, axis=1, keepdims=True), 1e-12)
+
+    def search(self, descriptors, k=100):
+        '''
+        top k database nodes of each query, (query_num x k) ids (or names) and similarities.
+        '''
+        sort_id, sort_sim = topK(np.dot(self.encode(descriptors), self.new_features.T), k)
+        if self.names is not None:
+            return [[self.names[i] for i in row] for row in sort_id], sort_sim
+        return sort_id, sort_sim
+
+def serveStdin(engine, k, feat_dim):
+    '''
+    one query per line: feat_dim numbers or the path of a .npy descriptor (file).
+    a line "ids<TAB>latency ms" is written per query, the latency distribution at the end.
+    '''
+    latency = []
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        descriptor = np.load(line) if line.endswith('.npy') else np.array(line.replace(',', ' ').split(), dtype=np.float32)
+        start = time.time()
+        ids, _ = engine.search(descriptor.reshape(-1, feat_dim), k)
+        latency.append((time.time() - start) * 1000)
+        for row in ids:
+            print "{}\t{:.2f}".format(" ".join(str(i) for i in row), latency[-1])
+        sys.stdout.flush()
+    if latency:
+        print >> sys.stderr, "queries: {}, latency (ms) mean: {:.2f}, p50: {:.2f}, p99: {:.2f}".format(
+            len(latency), np.mean(latency), np.percentile(latency, 50), np.percentile(latency, 99))
+
+def serveHTTP(engine, k, feat_dim, port):
+    '''
+    POST a micro-batch of raw little-endian float32 descriptors (query_num x feat_dim),
+    the response is json {"ids": [...], "scores": [...], "ms": latency}. ?k= overrides the number of results (400 if not a positive integer).
+    '''
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            descriptors = np.frombuffer(body, dtype='<f4')
+            if len(descriptors) == 0 or len(descriptors) % feat_dim != 0:
+                self.send_error(400, "expected a multiple of {} float32 values".format(feat_dim))
+                return
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            try:
+                query_k = int(query['k'][0]) if 'k' in query else k
+            except ValueError:
+                query_k = 0
+            if query_k <= 0:
+                self.send_error(400, "k must be a positive integer")
+                return
+            start = time.time()
+            ids, scores = engine.search(descriptors.reshape(-1, feat_dim), query_k)
+            result = json.dumps({
+                'ids': [list(row) for row in np.asarray(ids).tolist()],
+                'scores': np.asarray(scores).tolist(),
+                'ms': (time.time() - start) * 1000,
+            })
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(result)))
+            self.end_headers()
+            self.wfile.write(result)
+
+        def log_message(self, *args):
+            pass
+
+    print "serving on http://127.0.0.1:{}".format(port)
+    HTTPServer(('127.0.0.1', port), QueryHandler).serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Encode unseen queries with a trained single-layer GraphSAGE and retrieve from an indexed database.')
+    parser.add_argument('-c', '--checkpoint', type=str, required=True, help='checkpoint of main_single or main_single_unsup.')
+    parser.add_argument('-F', '--feature_map', type=str, required=True, help='database feature map (.npy), names are read from the manifest (.txt) next to it if any.')
+    parser.add_argument('-e', '--new_feature_map', type=str, default='', required=False, help='database features encoded by the checkpoint (.npy), computed at start if empty.')
+    parser.add_argument('-n', '--knn', type=int, default=0, required=False, help='number of neighbors, num_sample of the checkpoint if 0.')
+    parser.add_argument('-k', '--topk', type=int, default=100, required=False, help='number of results per query.')
+    parser.add_argument('-m', '--mode', type=str, default='stdin', choices=['stdin', 'http'], required=False, help='front end, \'stdin\' or \'http\'.')
+    parser.add_argument('-p', '--port', type=int, default=8100, required=False, help='port of the http front end.')
+    parser.add_argument('-N', '--names', type=ast.literal_eval, default=True, required=False, help='whether to return database names (True) or ids (False).')
+    args, _ = parser.parse_known_args()
+
+    feature_map = np.load(args.feature_map)
+    manifest = os.path.splitext(args.feature_map)[0] + '.txt'
+    names = open(manifest).read().splitlines() if args.names and os.path.exists(manifest) else None
+    new_feature_map = np.load(args.new_feature_map) if args.new_feature_map else None
+
+    start = time.time()
+    engine = QueryEngine(args.checkpoint, feature_map, args.knn or None, new_feature_map, names)
+    print >> sys.stderr, "index of {} nodes loaded in {:.2f}s".format(feature_map.shape[0], time.time() - start)
+
+    if args.mode == 'stdin':
+        serveStdin(engine, args.topk, feature_map.shape[1])
+    else:
+        serveHTTP(engine, args.topk, feature_map.shape[1], args.port)
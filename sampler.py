@@ -0,0 +1,118 @@
+import torch
+
+import numpy as np
+
+from graph import CSRGraph, CliqueGraph
+
+def batchRNG(seed, *keys):
+    '''
+    random generator of a batch, determined by seed and keys (e.g., epoch and batch number).
+    '''
+    return np.random.RandomState([seed] + [int(k) for k in keys])
+
+class NeighborSampler(object):
+    '''
+    sample neighbors for a whole batch of nodes at once.
+    '''
+
+    def __init__(self, adj_lists, num_sample=10, weighted=False, seed=None):
+        '''
+        adj_lists: CSRGraph (the set-based form is converted).
+        num_sample: number of neighbors to sample. No sampling if None
+        weighted=False: uniform sampling without replacement,
+        weighted=True: sampling without replacement proportional to edge weights.
+        seed: seed of the default generator, numpy's global generator is used if None.
+        '''
+        self.adj_lists = adj_lists if isinstance(adj_lists, CSRGraph) else CSRGraph.fromAdjLists(adj_lists)
+        self.num_sample = num_sample
+        self.weighted = weighted
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+
+    def __call__(self, nodes, rng=None):
+        '''
+        nodes: list of nodes in a batch
+        rng: generator of this batch, see batchRNG. The default generator if None.
+
+        return (batch x k) LongTensor of sampled neighbors (-1 for padding)
+        and (batch x k) FloatTensor of corresponding edge weights (0 for padding).
+        '''
+        rng = self.rng if rng is None else rng
+        if isinstance(self.adj_lists, CliqueGraph):
+            return self.adj_lists.sample(nodes, self.num_sample, rng)
+        neighbors = self.adj_lists.batch(nodes)
+        degree = neighbors.degree()
+        rows = neighbors.rows()
+        max_degree = int(degree.max()) if len(degree) > 0 else 0
+        k = max_degree if self.num_sample is None else min(self.num_sample, max_degree)
+
+        if k == max_degree:
+            order = np.arange(neighbors.edge_num)
+        else:
+            ## a random key per edge, the k smallest keys of each row are kept.
+            ## exponential keys scaled by weights give weighted sampling without replacement (Efraimidis-Spirakis).
+            keys = rng.random_sample(neighbors.edge_num)
+            if self.weighted:
+                with np.errstate(divide='ignore'):
+                    keys = -np.log(keys) / neighbors.weights
+            order = np.lexsort((keys, rows))
+        rank = np.arange(neighbors.edge_num) - neighbors.indptr[rows]
+        keep = rank < k
+
+        neigh_index = np.full((len(neighbors), k), -1, dtype=np.int64)
+        neigh_weight = np.zeros((len(neighbors), k), dtype=np.float32)
+        neigh_index[rows[keep], rank[keep]] = neighbors.indices[order[keep]]
+        neigh_weight[rows[keep], rank[keep]] = neighbors.weights[order[keep]]
+        return torch.from_numpy(neigh_index), torch.from_numpy(neigh_weight)
+
+class PairSampler(object):
+    '''
+    positive (and negative) pairs by label for a whole batch at once.
+    nodes are sorted by label once, a node of class c and its classmates are a contiguous block of the sorted nodes.
+    '''
+
+    def __init__(self, label, nodes, seed=None):
+        '''
+        label: labels of all nodes, nodes: nodes to draw pairs from (e.g., training nodes).
+        seed: seed of the default generator, numpy's global generator is used if None.
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        node_label = np.asarray(label).reshape(-1)[nodes]
+        order = np.argsort(node_label, kind='mergesort')
+        self.sorted_nodes = nodes[order]
+        _, start, count = np.unique(node_label[order], return_index=True, return_counts=True)
+        self.position = np.full(nodes.max() + 1 if len(nodes) > 0 else 0, -1, dtype=np.int64)
+        self.position[self.sorted_nodes] = np.arange(len(nodes))
+        self.start = np.repeat(start, count)
+        self.count = np.repeat(count, count)
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+
+    def positives(self, anchors, rng=None):
+        '''
+        a random node of the same label for each anchor (the anchor itself if it has no classmate).
+        '''
+        rng = self.rng if rng is None else rng
+        position = self.position[np.asarray(anchors, dtype=np.int64)]
+        start, count = self.start[position], self.count[position]
+        rank = (rng.random_sample(len(position)) * np.maximum(count - 1, 1)).astype(np.int64)
+        ## the rank-th classmate skips the anchor itself
+        pos = start + rank + (rank >= position - start)
+        pos[count == 1] = position[count == 1]
+        return self.sorted_nodes[pos]
+
+    def negatives(self, anchors, rng=None, features=None, candidate_num=10):
+        '''
+        a random node of another label for each anchor.
+        if features (node_num x feat_dim) are given, the hardest (most similar) of candidate_num random negatives is returned.
+        '''
+        rng = self.rng if rng is None else rng
+        anchors = np.asarray(anchors, dtype=np.int64)
+        position = self.position[anchors]
+        start, count = self.start[position], self.count[position]
+        draw_num = 1 if features is None else candidate_num
+        rank = (rng.random_sample((len(anchors), draw_num)) * (len(self.sorted_nodes) - count)[:, None]).astype(np.int64)
+        ## skip the block of the anchor's class
+        candidates = self.sorted_nodes[rank + (rank >= start[:, None]) * count[:, None]]
+        if features is None:
+            return candidates[:, 0]
+        similarity = np.einsum('ij,ikj->ik', features[anchors], features[candidates.reshape(-1)].reshape(candidates.shape + (-1,)))
+        return candidates[np.arange(len(anchors)), np.argmax(similarity, axis=1)]
@@ -1,57 +1,243 @@
 import os
 from collections import OrderedDict
 import subprocess
+import hashlib
+import shutil
+import tempfile
 import numpy as np
 
+from knn import knnSearch
+
+def averagePrecision(ranks, relevant, junk, relevant_num, k=None):
+    '''
+    AP of the Oxford/Paris compute_ap protocol, vectorized over queries.
+    junk images are skipped, AP is the trapezoidal area under the precision-recall curve.
+    ranks: (query_num x n) ranked database indices, n may be smaller than the database size.
+    relevant, junk: (query_num x db_num) boolean masks.
+    relevant_num: number of relevant (good + ok) images of each query.
+    k: AP@k, only the first k non-junk images of each ranking count if not None.
+    '''
+    rows = np.arange(ranks.shape[0])[:, None]
+    keep = ~junk[rows, ranks]
+    position = np.cumsum(keep, axis=1)
+    hit = relevant[rows, ranks] & keep
+    if k is not None:
+        hit &= position <= k
+    intersect = np.cumsum(hit, axis=1)
+    ## at a hit, recall rises by 1/relevant_num and the precision before it is (intersect-1)/(position-1)
+    precision = intersect / np.maximum(position, 1).astype(np.float64)
+    old_precision = np.where(position > 1, (intersect - 1) / np.maximum(position - 1, 1).astype(np.float64), 1.0)
+    ap = np.sum(np.where(hit, precision + old_precision, 0.0), axis=1) / 2.0
+    return ap / np.asarray(relevant_num, dtype=np.float64)
+
+def precisionAtK(ranks, relevant, junk, k):
+    '''
+    fraction of relevant images among the first k non-junk images of each ranking.
+    '''
+    rows = np.arange(ranks.shape[0])[:, None]
+    keep = ~junk[rows, ranks]
+    hit = relevant[rows, ranks] & keep & (np.cumsum(keep, axis=1) <= k)
+    return np.sum(hit, axis=1) / float(k)
+
+class LazyRegistry(object):
+    '''
+    dict-like registry of datasets, evaluators etc., each value is constructed on first access and memoized.
+    '''
+
+    def __init__(self, factories):
+        '''
+        factories: list of (key, function without argument returning the value).
+        '''
+        self.factories = OrderedDict(factories)
+        self.values = {}
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            self.values[key] = self.factories[key]()
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.factories
+
+    def __len__(self):
+        return len(self.factories)
+
+    def keys(self):
+        return list(self.factories.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.factories]
+
+def readNames(path):
+    return set([e.strip() for e in file(path)]) - set([''])
+
 class buildTestData:
-    def __init__(self, img_path, gt_path, eval_func):
+    def __init__(self, img_path, gt_path, eval_func, cache_dir=None):
+        '''
+        cache_dir: folder to cache the parsed ground truth, keyed by modification time of gt_path. No cache if None.
+        '''
         self.img_path = img_path
         self.gt_path = gt_path
         self.eval_func = eval_func
+        self.cache_dir = cache_dir
 
         self.build()
     def build(self):
-        gt_files = np.sort(os.listdir(self.gt_path))
         ## get the image names without the extension
         self.img_names = [img[:-4] for img in np.sort(os.listdir(self.img_path))]
+        self.img_num = len(self.img_names)
+
+        gt = self.loadCache()
+        if gt is None:
+            gt = self.parseGroundTruth()
+            self.saveCache(gt)
+
+        self.q_names = list(gt['q_names'])
+        self.q_index = gt['q_index']
+        self.q_num = len(self.q_index)
+        self.name_to_file = OrderedDict(zip(self.q_names, [self.img_names[i] for i in self.q_index]))
+        ## relevant (good + ok) and junk images of the i-th query are *_idx[*_ptr[i]:*_ptr[i+1]]
+        self.relevant = OrderedDict((q, gt['relevant_idx'][gt['relevant_ptr'][i]:gt['relevant_ptr'][i+1]]) for i, q in enumerate(self.q_names))
+        self.junk = OrderedDict((q, gt['junk_idx'][gt['junk_ptr'][i]:gt['junk_ptr'][i+1]]) for i, q in enumerate(self.q_names))
+        self.relevant_count = gt['relevant_num']
+        self.relevant_num = dict(zip(self.q_names, self.relevant_count))
+
+        ## (q_num x img_num) masks for the native evaluator
+        self.relevant_mask = np.zeros((self.q_num, self.img_num), dtype=bool)
+        self.junk_mask = np.zeros((self.q_num, self.img_num), dtype=bool)
+        for i, q in enumerate(self.q_names):
+            self.relevant_mask[i, self.relevant[q]] = True
+            self.junk_mask[i, self.junk[q]] = True
+
+    def nonRelevant(self, q_name):
+        i = self.q_names.index(q_name)
+        return np.where(~(self.relevant_mask[i] | self.junk_mask[i]))[0]
 
-        self.relevant = {}
-        self.non_relevant = {}
-        self.junk = {}
+    def parseGroundTruth(self):
+        '''
+        read *_query.txt, *_good.txt, *_ok.txt and *_junk.txt, image names are resolved by a name -> index hash.
+        '''
+        name_index = dict(zip(self.img_names, range(self.img_num)))
+        lookup = lambda names: np.array(sorted(name_index[n] for n in names if n in name_index), dtype=np.int64)
 
-        self.name_to_file = OrderedDict()
-        for f in gt_files:
+        q_names, q_index, relevant, junk, relevant_num = [], [], [], [], []
+        for f in np.sort(os.listdir(self.gt_path)):
             if f.endswith('_query.txt'):
                 q_name = f[:-len('_query.txt')]
                 q_data = file("{}/{}".format(self.gt_path, f)).readline().split(' ')
                 q_imgname = q_data[0][5:] if q_data[0].startswith('oxc1') else q_data[0]
-                self.name_to_file[q_name] = q_imgname
-                good = set([e.strip() for e in file("{}/{}_ok.txt".format(self.gt_path, q_name))])
-                good = good.union(set([e.strip() for e in file("{}/{}_good.txt".format(self.gt_path, q_name))]))
-                junk = set([e.strip() for e in file("{}/{}_junk.txt".format(self.gt_path, q_name))])
-                good_plus_junk = good.union(junk)
-                self.relevant[q_name] = [i for i in range(len(self.img_names)) if self.img_names[i] in good]
-                self.non_relevant[q_name] = [i for i in range(len(self.img_names)) if self.img_names[i] not in good_plus_junk]
-                self.junk[q_name] = [i for i in range(len(self.img_names)) if self.img_names[i] in junk]
-
-        self.q_names = self.name_to_file.keys()
-        self.q_index = np.array([self.img_names.index(self.name_to_file[q]) for q in self.q_names])
-        self.img_num = len(self.img_names)
-        self.q_num = len(self.q_index)
+                good = readNames("{}/{}_ok.txt".format(self.gt_path, q_name))
+                good = good.union(readNames("{}/{}_good.txt".format(self.gt_path, q_name)))
+                q_names.append(q_name)
+                q_index.append(name_index[q_imgname])
+                relevant.append(lookup(good))
+                junk.append(lookup(readNames("{}/{}_junk.txt".format(self.gt_path, q_name))))
+                relevant_num.append(len(good))
 
-    def evalRetrieval(self, similarity, save_path):
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-        ranks = np.argsort(similarity, axis=1)[:,::-1]
-        APs = [self.eval_q(i, ranks[q,:], save_path) for (i, q) in enumerate(self.q_index)]
+        offsets = lambda lists: np.concatenate(([0], np.cumsum([len(l) for l in lists]))).astype(np.int64)
+        concat = lambda lists: np.concatenate(lists).astype(np.int64) if len(lists) > 0 else np.zeros(0, dtype=np.int64)
+        return {
+            'q_names': np.array(q_names),
+            'q_index': np.array(q_index, dtype=np.int64),
+            'relevant_ptr': offsets(relevant),
+            'relevant_idx': concat(relevant),
+            'junk_ptr': offsets(junk),
+            'junk_idx': concat(junk),
+            'relevant_num': np.array(relevant_num, dtype=np.int64),
+        }
+
+    def cacheFile(self):
+        gt_key = hashlib.md5("{}|{}".format(os.path.abspath(self.gt_path), os.path.abspath(self.img_path))).hexdigest()[:12]
+        return os.path.join(self.cache_dir, 'gt_{}.npz'.format(gt_key))
+
+    def cacheKey(self):
+        ## ground truth files and image list may change without touching each other
+        mtime = max([os.path.getmtime(self.gt_path)] + [os.path.getmtime(os.path.join(self.gt_path, f)) for f in os.listdir(self.gt_path)])
+        return np.array([mtime, os.path.getmtime(self.img_path), self.img_num])
+
+    def loadCache(self):
+        if self.cache_dir is None or not os.path.exists(self.cacheFile()):
+            return None
+        cache = np.load(self.cacheFile())
+        if not np.array_equal(cache['key'], self.cacheKey()):
+            return None
+        return dict((k, cache[k]) for k in cache.files if k != 'key')
+
+    def saveCache(self, gt):
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        np.savez(self.cacheFile(), key=self.cacheKey(), **gt)
+
+    def rankQueries(self, similarity):
+        return np.argsort(similarity[self.q_index], axis=1)[:,::-1]
+
+    def rankFeatures(self, feature_map, k=None, mem_budget=1<<28):
+        '''
+        ranked database indices of the queries by inner product of (img_num x dim) feature_map.
+        only the (query_num x img_num) scores are computed, chunk by chunk within mem_budget bytes.
+        if k is given, only the top region holding the first k non-junk images is ranked (argpartition).
+        '''
+        n = self.img_num if k is None else min(self.img_num, k + int(self.junk_mask.sum(1).max()))
+        return knnSearch(feature_map[self.q_index], feature_map, n, mem_budget)[0]
+
+    def evalRanks(self, ranks, save_path=None, native=True, k=None):
+        '''
+        mAP (mAP@k if k is given) of ranked queries.
+        AP is computed in-process unless native=False, which runs eval_func on the rank lists.
+        rank lists (.rnkl) are written to save_path if given, to a temporary directory if native=False without save_path.
+        '''
+        rank_path = tempfile.mkdtemp() if save_path is None and not native else save_path
+        if rank_path is not None:
+            self.writeRanks(ranks, rank_path)
+        if native:
+            APs = averagePrecision(ranks, self.relevant_mask, self.junk_mask, self.relevant_count, k)
+        else:
+            try:
+                APs = [self.eval_q(q, ranks[q,:], rank_path) for q in range(self.q_num)]
+            finally:
+                if rank_path != save_path:
+                    shutil.rmtree(rank_path)
         # for q in range(self.q_num):
         #     print "{}: {:.4f}".format(self.q_names[q], APs[q])
         return np.mean(APs)
 
+    def evalRetrieval(self, similarity, save_path=None, native=True):
+        '''
+        mAP of the queries given (img_num x img_num) similarity.
+        '''
+        return self.evalRanks(self.rankQueries(similarity), save_path, native)
+
+    def evalFeature(self, feature_map, save_path=None, native=True, k=None):
+        '''
+        mAP (mAP@k if k is given) of the queries given (img_num x dim) feature_map, see rankFeatures.
+        '''
+        return self.evalRanks(self.rankFeatures(feature_map, k), save_path, native, k)
+
+    def evalMetrics(self, feature_map, ks=(1, 5, 10, 100)):
+        '''
+        mAP, mAP@k and precision@k of the queries given (img_num x dim) feature_map.
+        '''
+        ranks = self.rankFeatures(feature_map)
+        metrics = {'mAP': np.mean(averagePrecision(ranks, self.relevant_mask, self.junk_mask, self.relevant_count))}
+        for k in ks:
+            metrics['mAP@{}'.format(k)] = np.mean(averagePrecision(ranks, self.relevant_mask, self.junk_mask, self.relevant_count, k))
+            metrics['P@{}'.format(k)] = np.mean(precisionAtK(ranks, self.relevant_mask, self.junk_mask, k))
+        return metrics
+
+    def writeRanks(self, ranks, save_path):
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        for q in range(self.q_num):
+            rank_list = np.array(self.img_names)[ranks[q]]
+            with open("{}/{}.rnkl".format(save_path, self.q_names[q]), 'w') as fw:
+                fw.write("\n".join(rank_list)+"\n")
+
     def eval_q(self, q, rank, save_path):
-        rank_list = np.array(self.img_names)[rank]
-        with open("{}/{}.rnkl".format(save_path, self.q_names[q]), 'w') as fw:
-            fw.write("\n".join(rank_list)+"\n")
+        '''
+        AP of the q-th query by eval_func (compute_ap) on the rank list written by writeRanks.
+        '''
         command = "{0} {1}/{2} {3}/{4}.rnkl".format(self.eval_func, self.gt_path, self.q_names[q], save_path, self.q_names[q])
         sp = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         AP = float(sp.stdout.readlines()[0])
@@ -0,0 +1,48 @@
+import torch
+
+import numpy as np
+
+class EmbeddingWriter(object):
+    '''
+    (row_num x dim) output buffer filled batch by batch in place.
+    the buffer is a memory-mapped .npy file (header written up front) if path is given, an array in memory otherwise.
+    dim may be left None, the buffer is then allocated at the first batch.
+    '''
+
+    def __init__(self, row_num, dim=None, path=None, dtype='float32'):
+        self.row_num = row_num
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.ptr = 0
+        self.buffer = None
+        if dim is not None:
+            self.allocate(dim)
+
+    def allocate(self, dim):
+        if self.path is not None:
+            self.buffer = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype, shape=(self.row_num, dim))
+        else:
+            self.buffer = np.empty((self.row_num, dim), dtype=self.dtype)
+
+    def write(self, batch):
+        '''
+        batch: (batch x dim) FloatTensor or array, rows follow the previous batch.
+        '''
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        if self.buffer is None:
+            self.allocate(batch.shape[1])
+        if self.ptr + len(batch) > self.row_num:
+            raise ValueError("{} rows written to a buffer of {} rows".format(self.ptr + len(batch), self.row_num))
+        self.buffer[self.ptr:self.ptr+len(batch)] = batch
+        self.ptr += len(batch)
+
+    def finish(self):
+        '''
+        return the filled buffer.
+        '''
+        if self.ptr != self.row_num:
+            raise ValueError("{} rows written to a buffer of {} rows".format(self.ptr, self.row_num))
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
+        return self.buffer